@@ -62,6 +62,8 @@ from dateutil.tz import gettz
 #####################################################################
 # Import SmartHome.py Modules
 #####################################################################
+import lib.cache
+import lib.clock
 import lib.config
 import lib.connection
 import lib.daemon
@@ -134,6 +136,7 @@ class SmartHome():
         self.tz = 'UTC'
         os.environ['TZ'] = self.tz
         self._tzinfo = TZ
+        self.clock = lib.clock.Clock()  # lib.clock.VirtualClock() for simulations, see Scheduler.simulate()
 
         threading.currentThread().name = 'Main'
         self.alive = True
@@ -211,8 +214,8 @@ class SmartHome():
         else:
             if not hasattr(self, '_elev'):
                 self._elev = None
-            self.sun = lib.orb.Orb('sun', self._lon, self._lat, self._elev)
-            self.moon = lib.orb.Orb('moon', self._lon, self._lat, self._elev)
+            self.sun = lib.orb.Orb('sun', self._lon, self._lat, self._elev, clock=self.clock)
+            self.moon = lib.orb.Orb('moon', self._lon, self._lat, self._elev, clock=self.clock)
 
     def initLogging(self):
         fo = open(self._log_config, 'r') 
@@ -246,10 +249,24 @@ class SmartHome():
         #############################################################
         # Start Scheduler
         #############################################################
-        self.scheduler = lib.scheduler.Scheduler(self)
+        backend = getattr(self, '_scheduler_backend', 'thread')
+        if backend == 'asyncio' and sys.version_info < (3, 5):
+            self.logger.warning("scheduler_backend = asyncio needs Python 3.5 or newer, using the thread scheduler")
+            backend = 'thread'
+        if backend == 'asyncio':
+            import lib.scheduler_async  # async def is a syntax error before Python 3.5
+            self.scheduler = lib.scheduler_async.AsyncScheduler(self)
+        else:
+            self.scheduler = lib.scheduler.Scheduler(self)
         self.trigger = self.scheduler.trigger
         self.scheduler.start()
 
+        #############################################################
+        # Start Cache Writer
+        #############################################################
+        self.cache = lib.cache.CacheWriter(self)
+        self.cache.start()
+
         #############################################################
         # Init Connections
         #############################################################
@@ -279,29 +296,31 @@ class SmartHome():
                 except Exception as e:
                     self.logger.exception("Problem reading {0}: {1}".format(item_file, e))
                     continue
-        for attr, value in item_conf.items():
-            if isinstance(value, dict):
-                child_path = attr
-                try:
-                    child = lib.item.Item(self, self, child_path, value)
-                except Exception as e:
-                    self.logger.error("Item {}: problem creating: ()".format(child_path, e))
-                else:
-                    vars(self)[attr] = child
-                    self.add_item(child_path, child)
-                    self.__children.append(child)
-        del(item_conf)  # clean up
-        for item in self.return_items():
-            item._init_prerun()
-        for item in self.return_items():
-            item._init_run()
+        with self.scheduler.deferred():  # first fire times of all crontab/cycle items in one pass
+            for attr, value in item_conf.items():
+                if isinstance(value, dict):
+                    child_path = attr
+                    try:
+                        child = lib.item.Item(self, self, child_path, value)
+                    except Exception as e:
+                        self.logger.error("Item {}: problem creating: ()".format(child_path, e))
+                    else:
+                        vars(self)[attr] = child
+                        self.add_item(child_path, child)
+                        self.__children.append(child)
+            del(item_conf)  # clean up
+            for item in self.return_items():
+                item._init_prerun()
+            for item in self.return_items():
+                item._init_run()
         self.item_count = len(self.__items)
         self.logger.info("Items: {}".format(self.item_count))
 
         #############################################################
         # Init Logics
         #############################################################
-        self._logics = lib.logic.Logics(self, self._logic_conf, self._env_logic_conf)
+        with self.scheduler.deferred():
+            self._logics = lib.logic.Logics(self, self._logic_conf, self._env_logic_conf)
 
         #############################################################
         # Init Scenes
@@ -323,6 +342,13 @@ class SmartHome():
         #############################################################
         self.scheduler.add('sh.gc', self._maintenance, prio=8, cron=['init', '4 2 * *'], offset=0)
 
+        #############################################################
+        # Precompute Sun and Moon Events
+        #############################################################
+        if self.sun:
+            self.scheduler.add('sh.sun', self.sun.precompute, prio=5, cron='0 0 * *')
+            self.scheduler.add('sh.moon', self.moon.precompute, prio=5, cron='0 0 * *')
+
         #############################################################
         # Main Loop
         #############################################################
@@ -349,6 +375,10 @@ class SmartHome():
             self.connections.close()
         except:
             pass
+        try:
+            self.cache.stop()
+        except:
+            pass
         for thread in threading.enumerate():
             try:
                 thread.join(1)
@@ -460,14 +490,14 @@ class SmartHome():
     #################################################################
     def now(self):
         # tz aware 'localtime'
-        return datetime.datetime.now(self._tzinfo)
+        return self.clock.now(self._tzinfo)
 
     def tzinfo(self):
         return self._tzinfo
 
     def utcnow(self):
         # tz aware utc time
-        return datetime.datetime.now(self._utctz)
+        return self.clock.now(self._utctz)
 
     def utcinfo(self):
         return self._utctz
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#
+# Evaluation of item eval expressions: parsing the string on every evaluation against the
+# expression compiled at init and the running aggregate of eval = avg.
+#
+# usage: dev/eval_benchmark.py [SOURCES]
+#
+# Builds an item with eval = avg over SOURCES items (default 20) and times the evaluation of the
+# expanded expression and a change of one source with the aggregate.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import lib.item
+from tests.common import MockSmartHome
+
+
+def main():
+    sources = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sh = MockSmartHome()
+    conf = {'sensor{}'.format(index): {'type': 'num', 'value': index} for index in range(sources)}
+    conf['avg'] = {'type': 'num', 'eval': 'avg', 'eval_trigger': 'temp.sensor*'}
+    sh.temp = lib.item.Item(sh, sh, 'temp', conf)
+    avg = sh.items['temp.avg']
+    avg._init_prerun()
+    namespace = {'sh': sh}
+    number = 20000
+    for name, expression in (('string', avg._eval), ('compiled', avg._eval_code)):
+        seconds = timeit.timeit(lambda: eval(expression, namespace), number=number)
+        print("{:9}: {:6.1f} µs per evaluation".format(name, seconds / number * 1e6))
+    aggregate = avg._aggregate
+
+    def change():
+        aggregate.update('temp.sensor0', 1)
+        return aggregate.result()
+    seconds = timeit.timeit(change, number=number)
+    print("{:9}: {:6.1f} µs per evaluation".format('aggregate', seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
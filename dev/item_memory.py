@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#
+# Memory per item of the item tree.
+#
+# usage: dev/item_memory.py [ITEMS]
+#
+# Builds ITEMS items (default 40000) in groups of 100 with the attributes of a typical
+# installation and reports the traced memory per item. Plugins and the scheduler are not loaded.
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import lib.item
+from tests.common import MockSmartHome
+
+
+def config(items):
+    conf = {}
+    for group in range(items // 100):
+        conf['group{}'.format(group)] = children = {}
+        for index in range(100):
+            children['item{}'.format(index)] = {'type': 'num', 'visu': 'yes', 'sqlite': 'yes'}
+    return conf
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    sh = MockSmartHome()
+    conf = config(items)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    top = [lib.item.Item(sh, sh, path, value) for path, value in conf.items()]  # noqa
+    after = tracemalloc.take_snapshot()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    count = len(sh.items) + len(conf)
+    print("{} items: {:.1f} MB, {:.0f} bytes per item".format(count, size / 1024 / 1024, size / count))
+
+
+if __name__ == '__main__':
+    main()
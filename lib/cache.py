@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+Cache of item values (``cache = yes``, ``sh.cache``).
+
+All cached values are loaded with one bulk read of the backend before the items are created.
+Items hand their new values to the CacheWriter instead of writing in the updating thread. The
+writer keeps only the latest value per item and writes all pending values every
+``cache_interval`` seconds and at shutdown.
+
+Backends (``cache_backend``):
+
+- ``sqlite`` (default): one SQLite database in WAL mode, var/cache/.items.db. Per item files of
+  the file backend are migrated into it at startup.
+- ``file``: one pickle file per item in var/cache/.
+"""
+
+import datetime
+import logging
+import os
+import pickle
+import sqlite3
+import stat
+import threading
+import time
+
+import lib.clock
+
+logger = logging.getLogger(__name__)
+
+
+def write(filename, value, changed=None):
+    # atomic: readers and a power loss see either the old or the new value, never a partial file
+    # changed: timestamp of the last change of the value, stored as the modification time
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(value, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if changed is not None:
+        os.utime(tmp, (changed, changed))
+    os.rename(tmp, filename)  # atomic on POSIX, os.replace() needs Python 3.3
+
+
+def _read_files(directory):
+    # the per item files of the file backend: {path: (timestamp, value)}
+    values = {}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return values
+    for name in names:
+        if name.startswith('.') or name.endswith('.tmp'):
+            continue
+        filename = os.path.join(directory, name)
+        try:
+            status = os.stat(filename)
+            if not stat.S_ISREG(status.st_mode):
+                continue
+            with open(filename, 'rb') as f:
+                values[name] = (status.st_mtime, pickle.load(f))
+        except Exception as e:
+            logger.warning("Item {}: problem reading cache: {}".format(name, e))
+    return values
+
+
+class FileCache():
+    # one pickle file per item, the file name is the item path
+
+    def __init__(self, directory):
+        self._dir = directory
+
+    def load(self):
+        return _read_files(self._dir)
+
+    def write(self, values):
+        # values: {path: (timestamp of the last change, value)}, returns the number of errors
+        errors = 0
+        for path, (changed, value) in values.items():
+            try:
+                write(os.path.join(self._dir, path), value, changed)
+            except Exception as e:
+                errors += 1
+                logger.warning("Could not write to {}: {}".format(os.path.join(self._dir, path), e))
+        return errors
+
+    def close(self):
+        pass
+
+
+class SQLiteCache():
+    # all items in one table. In WAL mode a write appends to the log, SQLite checkpoints (compacts) it.
+
+    def __init__(self, directory, name='.items.db'):
+        self._dir = directory
+        # check_same_thread: the CacheWriter uses the connection from one thread at a time
+        self._db = sqlite3.connect(os.path.join(directory, name), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache (path TEXT PRIMARY KEY, changed REAL, value BLOB)")
+        self._db.commit()
+
+    def load(self):
+        values = {}
+        for path, changed, value in self._db.execute("SELECT path, changed, value FROM cache"):
+            try:
+                values[path] = (changed, pickle.loads(value))
+            except Exception as e:
+                logger.warning("Item {}: problem reading cache: {}".format(path, e))
+        values.update(self._migrate(values))
+        return values
+
+    def _migrate(self, values):
+        # import the per item files of the file backend which are newer than the database entries
+        files = _read_files(self._dir)
+        if not files:
+            return {}
+        migrated = {path: item for path, item in files.items() if path not in values or item[0] > values[path][0]}
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                                 ((path, changed, pickle.dumps(value)) for path, (changed, value) in migrated.items()))
+        for path in files:
+            try:
+                os.remove(os.path.join(self._dir, path))
+            except OSError as e:
+                logger.warning("Could not remove {}: {}".format(os.path.join(self._dir, path), e))
+        logger.info("Cache: migrated {} item files".format(len(migrated)))
+        return migrated
+
+    def write(self, values):
+        if self._db is None:
+            logger.warning("Could not write the cache: already closed")
+            return len(values)
+        rows = []
+        errors = 0
+        for path, (changed, value) in values.items():
+            try:
+                rows.append((path, changed, pickle.dumps(value)))
+            except Exception as e:
+                errors += 1
+                logger.warning("Item {}: could not cache {}: {}".format(path, value, e))
+        try:
+            with self._db:  # one transaction for all values
+                self._db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logger.warning("Could not write the cache: {}".format(e))
+            return len(values)
+        return errors
+
+    def close(self):
+        if self._db is None:
+            return
+        try:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            self._db.close()
+            self._db = None
+
+
+class CacheWriter(threading.Thread):
+
+    _interval = 5  # seconds between two flushes
+    _backends = {'file': FileCache, 'sqlite': SQLiteCache}
+
+    def __init__(self, smarthome):
+        threading.Thread.__init__(self, name='CacheWriter')
+        self.daemon = True
+        self._sh = smarthome
+        self.alive = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time, a newer value is never overwritten by an older
+        self._wakeup = threading.Event()
+        self._pending = {}  # path: (timestamp of the last change, latest value)
+        self._stats = {'pending': 0, 'written': 0, 'coalesced': 0, 'flushes': 0, 'errors': 0}
+        interval = getattr(smarthome, '_cache_interval', None)
+        if interval is not None:
+            try:
+                self._interval = max(0, float(interval))
+            except (TypeError, ValueError):
+                logger.warning("CacheWriter: invalid value {0} for cache_interval, using {1}".format(interval, self._interval))
+        backend = getattr(smarthome, '_cache_backend', 'sqlite')
+        if backend not in self._backends:
+            logger.warning("CacheWriter: unknown cache_backend {0}, using sqlite. Please use one of: {1}".format(backend, ', '.join(self._backends)))
+            backend = 'sqlite'
+        os.makedirs(smarthome._cache_dir, exist_ok=True)
+        self._backend = self._backends[backend](smarthome._cache_dir)
+        self._values = self._backend.load()  # path: (timestamp, value), consumed by read()
+
+    def start(self):
+        self.alive = True  # before the thread runs, a stop() right after start() must not be lost
+        threading.Thread.start(self)
+
+    def run(self):
+        while self.alive:
+            self._wakeup.wait(self._interval or None)  # cache_interval = 0 writes through, see write()
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        # write the pending values before the shutdown
+        self.alive = False
+        self._wakeup.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(5)
+        self.flush()
+        with self._flush_lock:
+            self._backend.close()
+
+    def read(self, path):
+        # (tz aware datetime of the last change, value) of the item or None if it is not cached yet
+        cached = self._values.pop(path, None)
+        if cached is None:
+            return None
+        timestamp, value = cached
+        return datetime.datetime.fromtimestamp(timestamp, self._sh._tzinfo), value
+
+    def write(self, path, value, changed=None):
+        # changed: tz aware datetime of the last change of the item, now if None
+        changed = time.time() if changed is None else lib.clock.timestamp(changed)
+        with self._lock:
+            if path in self._pending:
+                self._stats['coalesced'] += 1
+            self._pending[path] = (changed, value)
+        if self._interval == 0 or not self.alive:
+            # cache_interval = 0 or not running: write through
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            errors = self._backend.write(pending)
+            with self._lock:
+                self._stats['written'] += len(pending) - errors
+                self._stats['errors'] += errors
+                self._stats['flushes'] += 1
+
+    def stats(self):
+        # pending: values waiting to be written, written: values written since the start,
+        # coalesced: values replaced by a newer one before they were written
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
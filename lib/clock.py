@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+Time sources of SmartHomeNG (``sh.clock``).
+
+Clock is the system clock. VirtualClock only advances when told to, it is used by
+Scheduler.simulate() to run a day of schedules within seconds and for deterministic tests.
+"""
+
+import datetime
+import threading
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 3.2
+    monotonic = time.time
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def timestamp(dt):
+    # seconds since the epoch of a tz aware datetime, datetime.timestamp() needs Python 3.3
+    return (dt - _epoch).total_seconds()
+
+
+class Clock():
+
+    virtual = False
+
+    def now(self, tz):
+        # tz aware datetime
+        return datetime.datetime.now(tz)
+
+    def utcnow(self):
+        # naive utc datetime
+        return datetime.datetime.utcnow()
+
+    def time(self):
+        # seconds since the epoch
+        return time.time()
+
+    def monotonic(self):
+        return monotonic()
+
+
+class VirtualClock(Clock):
+
+    virtual = True
+
+    def __init__(self, start=None):
+        # start: tz aware datetime or seconds since the epoch, default now
+        if start is None:
+            start = time.time()
+        elif isinstance(start, datetime.datetime):
+            start = timestamp(start)
+        self._lock = threading.Lock()
+        self._epoch = start
+        self._monotonic = 0.0
+
+    def now(self, tz):
+        return datetime.datetime.fromtimestamp(self.time(), tz)
+
+    def utcnow(self):
+        return datetime.datetime.fromtimestamp(self.time(), datetime.timezone.utc).replace(tzinfo=None)
+
+    def time(self):
+        return self._epoch + self._monotonic
+
+    def monotonic(self):
+        return self._monotonic
+
+    def advance(self, seconds):
+        with self._lock:
+            if seconds > 0:
+                self._monotonic += seconds
+
+    def advance_to(self, monotonic):
+        with self._lock:
+            if monotonic > self._monotonic:
+                self._monotonic = monotonic
+
+    def set(self, dt):
+        # step the wall clock to the tz aware datetime (like NTP), the monotonic clock is not changed
+        with self._lock:
+            self._epoch = timestamp(dt) - self._monotonic
@@ -19,6 +19,27 @@ if gc.garbage != []:
 # Threads
 sh.env.core.threads(threading.activeCount())
 
+# Scheduler
+stats = sh.scheduler.stats()
+sh.env.core.scheduler.exceptions(sum(task['exceptions'] for task in stats.values()))
+sh.env.core.scheduler.overruns(sum(task['overruns'] for task in stats.values()))
+sh.env.core.scheduler.late(sum(task['late'] for task in stats.values()))
+if stats:
+    sh.env.core.scheduler.busiest(max(stats, key=lambda task: stats[task]['total']))
+queue = sh.scheduler.queue()
+sh.env.core.scheduler.queue(sum(band['queued'] for band in queue.values()))
+sh.env.core.scheduler.shed(sum(band['shed'] for band in queue.values()))
+workers = sh.scheduler.workers()
+sh.env.core.scheduler.workers(workers['size'])
+sh.env.core.scheduler.workers_busy(workers['busy'])
+sh.env.core.scheduler.workers_peak(workers['peak'])
+
+# Cache
+cache = sh.cache.stats()
+sh.env.core.cache.pending(cache['pending'])
+sh.env.core.cache.written(cache['written'])
+sh.env.core.cache.coalesced(cache['coalesced'])
+
 # Memory
 statusfile = "/proc/{0}/status".format(os.getpid())
 units = {'kB': 1024, 'mB': 1048576}
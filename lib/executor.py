@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+"""
+Execution of logics in separate processes (``executor = process`` in logic.conf).
+
+The logic runs in a pool of worker processes with a proxied ``sh`` object. Item values
+read by a logic during its last run are sent along with the next run, other values are
+requested from the main process on demand. Item writes and triggers are collected and
+applied in the main process in one batch after the logic has finished.
+"""
+
+import gc  # noqa
+import logging
+import time  # noqa
+import datetime
+import sys
+import traceback
+import threading
+import os
+import random  # noqa
+import types  # noqa
+import subprocess  # noqa
+import multiprocessing
+import queue
+
+logger = logging.getLogger(__name__)
+
+_MISSING = '__missing_item__'
+
+
+class ProcessExecutor():
+
+    def __init__(self, smarthome, processes=2):
+        self._sh = smarthome
+        self._size = processes
+        self._context = multiprocessing.get_context('spawn')  # forking a threaded process is not safe
+        self._idle = queue.Queue()
+        self._processes = []
+        self._lock = threading.Lock()
+        self._prefetch = {}  # logic name: item paths read during the last run
+
+    def run(self, logic, by, source, dest, value):
+        """
+        Runs the logic in a worker process and applies its item writes and triggers.
+        Blocks the calling (worker) thread until the logic has finished. Returns False
+        if the logic raised an exception.
+        """
+        try:
+            process, conn = self._acquire()
+        except Exception as e:
+            logger.error("Logic {0}: could not start a worker process: {1}".format(logic.name, e))
+            return False
+        trigger = {'by': by, 'source': source, 'dest': dest, 'value': value}
+        conf = dict((key, val) for key, val in logic.conf.items() if isinstance(val, (str, int, float, bool, list)))
+        reads = self._prefetch.get(logic.name, [])
+        try:
+            conn.send(('run', logic.name, logic.filename, conf, trigger, self._read(reads), self._sh.tzinfo()))
+            while True:
+                message = conn.recv()
+                if message[0] == 'get':
+                    conn.send(self._read(message[1]))
+                elif message[0] == 'log':
+                    logging.getLogger(logic.name).log(message[1], message[2])
+                elif message[0] == 'done':
+                    break
+        except (EOFError, OSError) as e:
+            logger.error("Logic {0}: worker process failed: {1}".format(logic.name, e))
+            self._discard(process, conn)
+            return False
+        except Exception as e:
+            logger.error("Logic {0}: problem running in worker process: {1}".format(logic.name, e))
+            self._discard(process, conn)
+            return False
+        self._idle.put((process, conn))
+        __, reads, writes, triggers, error = message
+        self._prefetch[logic.name] = reads
+        for path, val, caller, source, dest in writes:
+            item = self._sh.return_item(path)
+            if item is None:
+                logger.warning("Logic {0}: item {1} not found".format(logic.name, path))
+                continue
+            item(val, caller=caller, source=source, dest=dest)
+        for kwargs in triggers:
+            self._sh.trigger(**kwargs)
+        if error is not None:
+            logging.getLogger(logic.name).error("Logic: {0}, Exception: {1}".format(logic.name, error))
+            return False
+        return True
+
+    def stop(self):
+        with self._lock:
+            for process, conn in self._processes:
+                try:
+                    conn.send(('stop', ))
+                except Exception:
+                    pass
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+            self._processes = []
+
+    def _acquire(self):
+        # idle process or a new one if the pool is not full
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._processes) < self._size:
+                parent, child = self._context.Pipe()
+                process = self._context.Process(target=_process_main, args=(child, ), name='Logic process')
+                process.daemon = True
+                try:
+                    process.start()
+                except Exception:
+                    parent.close()
+                    child.close()
+                    raise
+                child.close()
+                self._processes.append((process, parent))
+                logger.info("Started logic worker process {0}".format(process.pid))
+                return process, parent
+        return self._idle.get()
+
+    def _discard(self, process, conn):
+        with self._lock:
+            if (process, conn) in self._processes:
+                self._processes.remove((process, conn))
+        if process.is_alive():
+            process.terminate()
+
+    def _read(self, paths):
+        values = {}
+        for path in paths:
+            item = self._sh.return_item(path)
+            values[path] = _MISSING if item is None else item()
+        return values
+
+
+#####################################################################
+# Worker Process
+#####################################################################
+
+class _Logger():
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def log(self, level, msg, *args):
+        self._conn.send(('log', level, str(msg) % args if args else str(msg)))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def critical(self, msg, *args):
+        self.log(logging.CRITICAL, msg, *args)
+
+    def exception(self, msg, *args):
+        self.log(logging.ERROR, (str(msg) % args if args else str(msg)) + '\n' + traceback.format_exc())
+
+
+class _ItemProxy():
+
+    def __init__(self, sh, path):
+        self._sh = sh
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _ItemProxy(self._sh, self._path + '.' + name)
+
+    def __call__(self, value=None, caller='Logic', source=None, dest=None):
+        if value is None:
+            return self._sh._get(self._path)
+        self._sh._set(self._path, value, caller, source, dest)
+
+    def __str__(self):
+        return self._path
+
+    def id(self):
+        return self._path
+
+
+class _SmartHomeProxy():
+
+    def __init__(self, conn, values, tzinfo):
+        self._conn = conn
+        self._values = values
+        self._tzinfo = tzinfo
+        self._reads = set()
+        self._writes = []
+        self._triggers = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _ItemProxy(self, name)
+
+    def _get(self, path):
+        self._reads.add(path)
+        if path not in self._values:
+            self._conn.send(('get', [path]))
+            self._values.update(self._conn.recv())
+        if isinstance(self._values[path], str) and self._values[path] == _MISSING:
+            raise AttributeError("Item {0} not found".format(path))
+        return self._values[path]
+
+    def _set(self, path, value, caller, source, dest):
+        self._values[path] = value
+        self._writes.append((path, value, caller, source, dest))
+
+    def return_item(self, path):
+        return _ItemProxy(self, path)
+
+    def trigger(self, name, by='Logic', source=None, value=None, dest=None, prio=3, dt=None):
+        self._triggers.append({'name': name, 'by': by, 'source': source, 'value': value, 'dest': dest, 'prio': prio, 'dt': dt})
+
+    def now(self):
+        return datetime.datetime.now(self._tzinfo)
+
+    def tzinfo(self):
+        return self._tzinfo
+
+
+class _Logic():
+
+    def __init__(self, sh, name, conf):
+        self.name = name
+        self.conf = conf
+        self._sh = sh
+        for attribute in conf:
+            vars(self)[attribute] = conf[attribute]
+
+    def id(self):
+        return self.name
+
+    def __str__(self):
+        return self.name
+
+    def trigger(self, by='Logic', source=None, value=None, dest=None, dt=None):
+        self._sh.trigger(self.name, by=by, source=source, value=value, dest=dest, dt=dt)
+
+
+# modules available in logics, like for logics run by the scheduler threads
+_modules = {'gc': gc, 'logging': logging, 'time': time, 'datetime': datetime, 'sys': sys, 'traceback': traceback, 'threading': threading, 'os': os, 'random': random, 'types': types, 'subprocess': subprocess}
+
+
+def _process_main(conn):
+    bytecode = {}  # filename: (mtime, code)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message[0] == 'stop':
+            return
+        __, name, filename, conf, trigger, values, tzinfo = message
+        sh = _SmartHomeProxy(conn, values, tzinfo)
+        logic = _Logic(sh, name, conf)  # noqa
+        error = None
+        try:
+            mtime = os.path.getmtime(filename)
+            if filename not in bytecode or bytecode[filename][0] != mtime:
+                with open(filename, encoding='UTF-8') as f:
+                    code = f.read().lstrip('\ufeff')  # remove BOM
+                bytecode[filename] = (mtime, compile(code, filename, 'exec'))
+            env = dict(_modules)
+            env.update({'sh': sh, 'logic': logic, 'trigger': trigger, 'logger': _Logger(conn), '__name__': name})
+            exec(bytecode[filename][1], env)
+        except SystemExit:
+            # ignore exit() call from logic.
+            pass
+        except Exception as e:
+            tb = traceback.extract_tb(sys.exc_info()[2])[-1]
+            error = "File: {0}, Line: {1}, Method: {2}, Exception: {3}".format(tb[0], tb[1], tb[2], e)
+        try:
+            conn.send(('done', sorted(sh._reads), sh._writes, sh._triggers, error))
+        except Exception as e:  # e.g. a value which could not be pickled
+            conn.send(('done', [], [], [], "Could not return results: {0}".format(e)))
@@ -19,14 +19,21 @@
 #  along with SmartHome.py. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import collections
 import datetime
+import heapq
 import logging
-import os
-import pickle
 import threading
 
 logger = logging.getLogger(__name__)
 
+# bound once and shared by all items instead of one bound method per item
+_log_info = logger.info
+_log_debug = logger.debug
+
+# guards the lazy creation of the per item condition
+_cond_lock = threading.Lock()
+
 
 #####################################################################
 # Cast Methods
@@ -94,26 +101,6 @@ def _cast_num(value):
     raise ValueError
 
 
-#####################################################################
-# Cache Methods
-#####################################################################
-def _cache_read(filename, tz):
-    ts = os.path.getmtime(filename)
-    dt = datetime.datetime.fromtimestamp(ts, tz)
-    value = None
-    with open(filename, 'rb') as f:
-        value = pickle.load(f)
-    return (dt, value)
-
-
-def _cache_write(filename, value):
-    try:
-        with open(filename, 'wb') as f:
-            pickle.dump(value, f)
-    except IOError:
-        logger.warning("Could not write to {}".format(filename))
-
-
 #####################################################################
 # Fade Method
 #####################################################################
@@ -139,6 +126,71 @@ def _fadejob(item, dest, step, delta):
         item(dest, 'Fader')
 
 
+#####################################################################
+# Aggregates
+#####################################################################
+class _Aggregate():
+    # running state of eval = sum/avg/min/max/and/or, updated with every change of a source item
+    # instead of reading all sources on every evaluation
+
+    __slots__ = ('_kind', '_values', '_lock', '_total', '_true', '_heap', '_removed', '_updates')
+
+    def __init__(self, kind, values):
+        # values: {path: current value of the source item}
+        self._kind = kind
+        self._values = dict(values)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        values = self._values.values()
+        self._updates = 0
+        self._total = sum(values)
+        self._true = sum(1 for value in values if value)
+        # min/max: heap (of the negated values for max) with lazy removal of old values
+        sign = -1 if self._kind == 'max' else 1
+        self._heap = [sign * value for value in values]
+        heapq.heapify(self._heap)
+        self._removed = collections.Counter()
+
+    def update(self, path, value):
+        with self._lock:
+            old = self._values[path]
+            self._values[path] = value
+            if self._kind in ('sum', 'avg'):
+                self._total += value - old
+                self._updates += 1
+                if self._updates >= len(self._values):  # amortized O(1), limits the drift of a float sum
+                    self._updates = 0
+                    self._total = sum(self._values.values())
+            elif self._kind in ('and', 'or'):
+                self._true += bool(value) - bool(old)
+            else:
+                sign = -1 if self._kind == 'max' else 1
+                self._removed[sign * old] += 1
+                heapq.heappush(self._heap, sign * value)
+                if len(self._heap) > 2 * len(self._values):
+                    self._reset()
+
+    def result(self):
+        with self._lock:
+            if self._kind == 'sum':
+                return self._total
+            elif self._kind == 'avg':
+                return self._total / len(self._values)
+            elif self._kind == 'and':
+                return self._true == len(self._values)
+            elif self._kind == 'or':
+                return self._true > 0
+            heap = self._heap
+            while heap[0] in self._removed:
+                removed = heapq.heappop(heap)
+                self._removed[removed] -= 1
+                if not self._removed[removed]:
+                    del self._removed[removed]
+            return -heap[0] if self._kind == 'max' else heap[0]
+
+
 #####################################################################
 # Item Class
 #####################################################################
@@ -146,27 +198,45 @@ def _fadejob(item, dest, step, delta):
 
 class Item():
 
+    # Items are the bulk of the memory of larger installations, so the core state lives in slots.
+    # Child items are kept in __children (name -> item) and resolved by __getattr__, rarely used
+    # state (condition, trigger lists, threshold) is only allocated when needed. The __dict__ slot
+    # keeps attributes set by plugins working, it is only allocated on first use.
+    __slots__ = ('_autotimer', '_cache', '_coalesce', 'cast', '__changed_by', '__children', 'conf',
+                 '_crontab', '_cycle', '_enforce_updates', '_eval', '_eval_code', '_aggregate', '_aggregates',
+                 '_fixed_rate', '_eval_trigger',
+                 '_fading', '_items_to_trigger', '__last_change', '__last_update', '__cond',
+                 '__logics_to_trigger', '_name', '__prev_change', '__prev_value', '__methods_to_trigger',
+                 '__parent', '_path', '_sh', '_threshold', '_type', '_value', '_change_logger',
+                 '__dict__', '__weakref__')
+
     def __init__(self, smarthome, parent, path, config):
+        self.__children = None
         self._autotimer = False
         self._cache = False
+        self._coalesce = False
         self.cast = _cast_bool
         self.__changed_by = 'Init:None'
-        self.__children = []
         self.conf = {}
         self._crontab = None
         self._cycle = None
         self._enforce_updates = False
         self._eval = None
+        self._eval_code = None  # compiled self._eval, False if it could not be compiled
+        self._aggregate = None  # _Aggregate of eval = sum/avg/..., None for other expressions
+        self._aggregates = ()  # _Aggregates with this item as a source
+        self._fixed_rate = False
         self._eval_trigger = False
         self._fading = False
-        self._items_to_trigger = []
-        self.__last_change = smarthome.now()
-        self.__last_update = smarthome.now()
-        self._lock = threading.Condition()
-        self.__logics_to_trigger = []
+        self._items_to_trigger = ()
+        now = smarthome.now()  # datetimes are immutable, one instance is shared
+        self.__last_change = now
+        self.__last_update = now
+        self.__cond = None
+        self.__logics_to_trigger = ()
         self._name = path
-        self.__prev_change = smarthome.now()
-        self.__methods_to_trigger = []
+        self.__prev_change = now
+        self.__methods_to_trigger = ()
         self.__parent = parent
         self._path = path
         self._sh = smarthome
@@ -174,9 +244,9 @@ class Item():
         self._type = None
         self._value = None
         if hasattr(smarthome, '_item_change_log'):
-            self._change_logger = logger.info
+            self._change_logger = _log_info
         else:
-            self._change_logger = logger.debug
+            self._change_logger = _log_debug
         #############################################################
         # Item Attributes
         #############################################################
@@ -184,7 +254,7 @@ class Item():
             if not isinstance(value, dict):
                 if attr in ['cycle', 'eval', 'name', 'type', 'value']:
                     setattr(self, '_' + attr, value)
-                elif attr in ['cache', 'enforce_updates']:  # cast to bool
+                elif attr in ['cache', 'coalesce', 'enforce_updates', 'fixed_rate']:  # cast to bool
                     try:
                         setattr(self, '_' + attr, _cast_bool(value))
                     except:
@@ -202,11 +272,9 @@ class Item():
                     low, __, high = value.rpartition(':')
                     if not low:
                         low = high
-                    self._threshold = True
-                    self.__th_crossed = False
-                    self.__th_low = float(low.strip())
-                    self.__th_high = float(high.strip())
-                    logger.debug("Item {}: set threshold => low: {} high: {}".format(self._path, self.__th_low, self.__th_high))
+                    # [crossed, low, high]
+                    self._threshold = [False, float(low.strip()), float(high.strip())]
+                    logger.debug("Item {}: set threshold => low: {} high: {}".format(self._path, self._threshold[1], self._threshold[2]))
                 else:
                     self.conf[attr] = value
         #############################################################
@@ -220,20 +288,24 @@ class Item():
                 except Exception as e:
                     logger.exception("Item {}: problem creating: {}".format(child_path, e))
                 else:
-                    vars(self)[attr] = child
+                    if self.__children is None:
+                        self.__children = {}
+                    self.__children[attr] = child
+                    if hasattr(Item, attr):
+                        # a child named like a method has to shadow it, as it did before the slots
+                        vars(self)[attr] = child
                     smarthome.add_item(child_path, child)
-                    self.__children.append(child)
         #############################################################
         # Cache
         #############################################################
+        cached = None
         if self._cache:
-            self._cache = self._sh._cache_dir + self._path
-            try:
-                self.__last_change, self._value = _cache_read(self._cache, self._sh._tzinfo)
+            # bulk loaded by sh.cache before the items are created
+            cached = self._sh.cache.read(self._path)
+            if cached is not None:
+                self.__last_change, self._value = cached
                 self.__last_update = self.__last_change
                 self.__changed_by = 'Cache:None'
-            except Exception as e:
-                logger.warning("Item {}: problem reading cache: {}".format(self._path, e))
         #############################################################
         # Type
         #############################################################
@@ -259,15 +331,14 @@ class Item():
         #############################################################
         # Cache write/init
         #############################################################
-        if self._cache:
-            if not os.path.isfile(self._cache):
-                _cache_write(self._cache, self._value)
-                logger.warning("Item {}: Created cache for item: {}".format(self._cache, self._cache))
+        if self._cache and cached is None:
+            self._sh.cache.write(self._path, self._value, self.__last_change)
+            logger.warning("Item {}: Created cache for item".format(self._path))
         #############################################################
         # Crontab/Cycle
         #############################################################
         if self._crontab is not None or self._cycle is not None:
-            self._sh.scheduler.add(self._path, self, cron=self._crontab, cycle=self._cycle)
+            self._sh.scheduler.add_item(self._path, self, cron=self._crontab, cycle=self._cycle, fixed_rate=self._fixed_rate)
         #############################################################
         # Plugins
         #############################################################
@@ -282,19 +353,43 @@ class Item():
             return self._value
         if self._eval:
             args = {'value': value, 'caller': caller, 'source': source, 'dest': dest}
-            self._sh.trigger(name=self._path + '-eval', obj=self.__run_eval, value=args, by=caller, source=source, dest=dest)
+            self._sh.trigger(name=self._path + '-eval', obj=self.__run_eval, value=args, by=caller, source=source, dest=dest, coalesce=self._coalesce)
         else:
             self.__update(value, caller, source, dest)
 
+    def __getattr__(self, name):
+        # only called if the regular lookup fails: child items, e.g. sh.living.light
+        try:
+            children = object.__getattribute__(self, '_Item__children')
+        except AttributeError:
+            raise AttributeError(name)
+        if children is not None and name in children:
+            return children[name]
+        raise AttributeError("Item {} has no attribute or child '{}'".format(object.__getattribute__(self, '_path'), name))
+
     def __iter__(self):
-        for child in self.__children:
-            yield child
+        return self.return_children()
 
     def __setitem__(self, item, value):
-        vars(self)[item] = value
+        setattr(self, item, value)
 
     def __getitem__(self, item):
-        return vars(self)[item]
+        if self.__children is not None and item in self.__children:
+            return self.__children[item]
+        try:
+            return getattr(self, item)
+        except AttributeError:
+            raise KeyError(item)
+
+    @property
+    def _lock(self):
+        cond = self.__cond
+        if cond is None:
+            with _cond_lock:
+                if self.__cond is None:
+                    self.__cond = threading.Condition()
+                cond = self.__cond
+        return cond
 
     def __bool__(self):
         return bool(self._value)
@@ -312,8 +407,12 @@ class Item():
                 _items.extend(self._sh.match_items(trigger))
             for item in _items:
                 if item != self:  # prevent loop
-                        item._items_to_trigger.append(self)
+                    if item._items_to_trigger == ():
+                        item._items_to_trigger = []
+                    item._items_to_trigger.append(self)
             if self._eval:
+                if self._eval in ('and', 'or', 'sum', 'avg', 'max', 'min'):
+                    self._init_aggregate(self._eval, _items)
                 items = ['sh.' + x.id() + '()' for x in _items]
                 if self._eval == 'and':
                     self._eval = ' and '.join(items)
@@ -327,6 +426,27 @@ class Item():
                     self._eval = 'max({0})'.format(','.join(items))
                 elif self._eval == 'min':
                     self._eval = 'min({0})'.format(','.join(items))
+        if self._eval:
+            self._compile_eval()
+
+    def _init_aggregate(self, kind, items):
+        # sources with other types, duplicates or the item itself are evaluated with the expanded expression
+        types = ('bool',) if kind in ('and', 'or') else ('num', 'bool')
+        if not items or self in items or len(set(items)) != len(items) or any(item._type not in types for item in items):
+            return
+        self._aggregate = _Aggregate(kind, {item._path: item._value for item in items})
+        for item in items:
+            if item._aggregates == ():
+                item._aggregates = []
+            item._aggregates.append(self._aggregate)
+
+    def _compile_eval(self):
+        # once at init instead of parsing the expression on every evaluation, errors are reported at startup
+        try:
+            self._eval_code = compile(self._eval, self._path + '.eval', 'eval')
+        except (SyntaxError, ValueError, TypeError) as e:
+            self._eval_code = False
+            logger.error("Item {}: problem compiling eval {}: {}".format(self._path, self._eval, e))
 
     def _init_run(self):
         if self._eval_trigger:
@@ -335,16 +455,23 @@ class Item():
 
     def __run_eval(self, value=None, caller='Eval', source=None, dest=None):
         if self._eval:
-            sh = self._sh  # noqa
-            try:
-                value = eval(self._eval)
-            except Exception as e:
-                logger.warning("Item {}: problem evaluating {}: {}".format(self._path, self._eval, e))
+            if self._aggregate is not None:
+                value = self._aggregate.result()
             else:
-                if value is None:
-                    logger.info("Item {}: evaluating {} returns None".format(self._path, self._eval))
-                else:
-                    self.__update(value, caller, source, dest)
+                if self._eval_code is None:  # item created after the init
+                    self._compile_eval()
+                if self._eval_code is False:
+                    return
+                sh = self._sh  # noqa
+                try:
+                    value = eval(self._eval_code)
+                except Exception as e:
+                    logger.warning("Item {}: problem evaluating {}: {}".format(self._path, self._eval, e))
+                    return
+            if value is None:
+                logger.info("Item {}: evaluating {} returns None".format(self._path, self._eval))
+            else:
+                self.__update(value, caller, source, dest)
 
     def __trigger_logics(self):
         for logic in self.__logics_to_trigger:
@@ -368,6 +495,8 @@ class Item():
             self.__prev_change = self.__last_change
             self.__last_change = self._sh.now()
             self.__changed_by = "{0}:{1}".format(caller, source)
+            for aggregate in self._aggregates:  # under the lock: in the order of the changes
+                aggregate.update(self._path, value)
             if caller != "fader":
                 self._fading = False
                 self._lock.notify_all()
@@ -381,42 +510,44 @@ class Item():
                 except Exception as e:
                     logger.exception("Item {}: problem running {}: {}".format(self._path, method, e))
             if self._threshold and self.__logics_to_trigger:
-                if self.__th_crossed and self._value <= self.__th_low:  # cross lower bound
-                    self.__th_crossed = False
+                threshold = self._threshold
+                if threshold[0] and self._value <= threshold[1]:  # cross lower bound
+                    threshold[0] = False
                     self.__trigger_logics()
-                elif not self.__th_crossed and self._value >= self.__th_high:  # cross upper bound
-                    self.__th_crossed = True
+                elif not threshold[0] and self._value >= threshold[2]:  # cross upper bound
+                    threshold[0] = True
                     self.__trigger_logics()
             elif self.__logics_to_trigger:
                 self.__trigger_logics()
             for item in self._items_to_trigger:
                 args = {'value': value, 'source': self._path}
-                self._sh.trigger(name=item.id(), obj=item.__run_eval, value=args, by=caller, source=source, dest=dest)
+                self._sh.trigger(name=item.id(), obj=item.__run_eval, value=args, by=caller, source=source, dest=dest, coalesce=item._coalesce)
         if _changed and self._cache and not self._fading:
-            try:
-                _cache_write(self._cache, self._value)
-            except Exception as e:
-                logger.warning("Item: {}: could update cache {}".format(self._path, e))
+            self._sh.cache.write(self._path, self._value, self.__last_change)  # written behind by the CacheWriter
         if self._autotimer and caller != 'Autotimer' and not self._fading:
             _time, _value = self._autotimer
             self.timer(_time, _value, True)
 
     def add_logic_trigger(self, logic):
-        self.__logics_to_trigger.append(logic)
+        self.get_logic_triggers().append(logic)
 
     def remove_logic_trigger(self, logic):
-        self.__logics_to_trigger.remove(logic)
+        self.get_logic_triggers().remove(logic)
 
     def get_logic_triggers(self):
+        if self.__logics_to_trigger == ():  # shared empty default
+            self.__logics_to_trigger = []
         return self.__logics_to_trigger
 
     def add_method_trigger(self, method):
-        self.__methods_to_trigger.append(method)
-    
+        self.get_method_triggers().append(method)
+
     def remove_method_trigger(self, method):
-        self.__methods_to_trigger.remove(method)
+        self.get_method_triggers().remove(method)
 
     def get_method_triggers(self):
+        if self.__methods_to_trigger == ():
+            self.__methods_to_trigger = []
         return self.__methods_to_trigger
 
     def age(self):
@@ -459,8 +590,9 @@ class Item():
         self._sh.scheduler.remove(self.id() + '-Timer')
 
     def return_children(self):
-        for child in self.__children:
-            yield child
+        if self.__children is not None:
+            for child in list(self.__children.values()):
+                yield child
 
     def return_parent(self):
         return self.__parent
@@ -476,6 +608,8 @@ class Item():
             return
         self._lock.acquire()
         self._value = value
+        for aggregate in self._aggregates:
+            aggregate.update(self._path, value)
         if prev_change is None:
             self.__prev_change = self.__last_change
         else:
@@ -21,8 +21,10 @@
 
 import logging
 import os
+import sys
 
 import lib.config
+from lib.utils import Utils
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +47,7 @@ class Logics():
             logic = Logic(self._sh, name, _config[name])
             if hasattr(logic, 'bytecode'):
                 self._logics[name] = logic
-                self._sh.scheduler.add(name, logic, logic.prio, logic.crontab, logic.cycle)
+                self._sh.scheduler.add(name, logic, logic.prio, logic.crontab, logic.cycle, fixed_rate=logic.fixed_rate)
             else:
                 continue
             # plugin hook
@@ -89,12 +91,27 @@ class Logic():
         self.crontab = None
         self.cycle = None
         self.prio = 3
+        self.coalesce = False
+        self.executor = 'thread'
+        self.fixed_rate = False
+        self.concurrency = 'queue'
         self.last = None
         self.conf = attributes
         for attribute in attributes:
             vars(self)[attribute] = attributes[attribute]
         self.generate_bytecode()
         self.prio = int(self.prio)
+        self.coalesce = Utils.to_bool(self.coalesce)
+        self.fixed_rate = Utils.to_bool(self.fixed_rate)
+        if self.executor not in ['thread', 'process']:
+            logger.warning("{}: unknown executor '{}' => using thread.".format(self.name, self.executor))
+            self.executor = 'thread'
+        if self.executor == 'process' and sys.version_info < (3, 4):
+            logger.warning("{}: executor 'process' needs Python 3.4 or newer => using thread.".format(self.name))
+            self.executor = 'thread'
+        if self.concurrency not in ['queue', 'skip', 'latest', 'parallel']:
+            logger.warning("{}: unknown concurrency '{}' => using queue.".format(self.name, self.concurrency))
+            self.concurrency = 'queue'
 
     def id(self):
         return self.name
@@ -103,10 +120,10 @@ class Logic():
         return self.name
 
     def __call__(self, caller='Logic', source=None, value=None, dest=None, dt=None):
-        self._sh.scheduler.trigger(self.name, self, prio=self.prio, by=caller, source=source, dest=dest, value=value, dt=dt)
+        self._sh.scheduler.trigger(self.name, self, prio=self.prio, by=caller, source=source, dest=dest, value=value, dt=dt, coalesce=self.coalesce)
 
     def trigger(self, by='Logic', source=None, value=None, dest=None, dt=None):
-        self._sh.scheduler.trigger(self.name, self, prio=self.prio, by=by, source=source, dest=dest, value=value, dt=dt)
+        self._sh.scheduler.trigger(self.name, self, prio=self.prio, by=by, source=source, dest=dest, value=value, dt=dt, coalesce=self.coalesce)
 
     def generate_bytecode(self):
         if hasattr(self, 'filename'):
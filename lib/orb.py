@@ -23,6 +23,7 @@
 import logging
 import datetime
 import math
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -33,15 +34,21 @@ except ImportError as e:
 
 
 import dateutil.relativedelta
+import lib.clock
 from dateutil.tz import tzutc
 
 
 class Orb():
 
-    def __init__(self, orb, lon, lat, elev=False):
+    _cache_size = 1000  # purge old ephemeris entries above this size
+
+    def __init__(self, orb, lon, lat, elev=False, clock=None):
         if ephem is None:
             logger.warning("Could not find/use ephem!")
             return
+        self._clock = clock or lib.clock.Clock()
+        self._lock = threading.Lock()
+        self._events = {}  # (kind, horizon, center, start): first rising/setting after start (naive utc)
         self._obs = ephem.Observer()
         self._obs.long = str(lon)
         self._obs.lat = str(lat)
@@ -55,62 +62,105 @@ class Orb():
             self.light = self._light
 
     def rise(self, doff=0, moff=0, center=True, dt=None):
-        # workaround if rise is 0.001 seconds in the past
-        if dt is not None:
-            self._obs.date = dt - dt.utcoffset()
-        else:
-            self._obs.date = datetime.datetime.utcnow() - dateutil.relativedelta.relativedelta(minutes=moff) + dateutil.relativedelta.relativedelta(seconds=2)
-        self._obs.horizon = str(doff)
-        if doff != 0:
-            next_rising = self._obs.next_rising(self._orb, use_center=center).datetime()
-        else:
-            next_rising = self._obs.next_rising(self._orb).datetime()
-        next_rising = next_rising + dateutil.relativedelta.relativedelta(minutes=moff)
-        return next_rising.replace(tzinfo=tzutc())
+        return self._next_event('rise', doff, moff, center, dt)
 
     def set(self, doff=0, moff=0, center=True, dt=None):
-        # workaround if set is 0.001 seconds in the past
+        return self._next_event('set', doff, moff, center, dt)
+
+    def set_clock(self, clock):
+        # sh.clock was replaced, e.g. by a VirtualClock for Scheduler.simulate()
+        self._clock = clock
+
+    def precompute(self, day=None):
+        """
+        Calculates the events of today and tomorrow (utc) and the following ones for every horizon
+        in use and drops the entries of past days. Called by the scheduler at local midnight, which
+        is hours before the next utc day east of Greenwich.
+        The following event is looked up with the key _next_event() uses after the day's event.
+        """
+        if day is None:
+            day = self._clock.utcnow().date()
+        start = datetime.datetime(day.year, day.month, day.day)
+        with self._lock:
+            keys = set(key[:3] for key in self._events)
+            for key in list(self._events):
+                if key[3] < start - datetime.timedelta(days=1):
+                    del(self._events[key])
+        for kind, doff, center in keys:
+            for midnight in (start, start + datetime.timedelta(days=1)):
+                event = self._event(kind, doff, center, midnight)
+                self._event(kind, doff, center, event + datetime.timedelta(seconds=1))
+
+    def _next_event(self, kind, doff, moff, center, dt):
         if dt is not None:
-            self._obs.date = dt - dt.utcoffset()
+            origin = dt.replace(tzinfo=None) - dt.utcoffset()
         else:
-            self._obs.date = datetime.datetime.utcnow() - dateutil.relativedelta.relativedelta(minutes=moff) + dateutil.relativedelta.relativedelta(seconds=2)
-        self._obs.horizon = str(doff)
-        if doff != 0:
-            next_setting = self._obs.next_setting(self._orb, use_center=center).datetime()
-        else:
-            next_setting = self._obs.next_setting(self._orb).datetime()
-        next_setting = next_setting + dateutil.relativedelta.relativedelta(minutes=moff)
-        return next_setting.replace(tzinfo=tzutc())
+            # workaround if the event is 0.001 seconds in the past
+            origin = self._clock.utcnow() - datetime.timedelta(minutes=moff) + datetime.timedelta(seconds=2)
+        if doff == 0:
+            center = False  # ephem default
+        # walk from midnight over the (cached) events of the day up to the first one after origin
+        start = datetime.datetime(origin.year, origin.month, origin.day)
+        event = self._event(kind, doff, center, start)
+        while event <= origin:
+            event = self._event(kind, doff, center, event + datetime.timedelta(seconds=1))
+        event = event + datetime.timedelta(minutes=moff)
+        return event.replace(tzinfo=tzutc())
+
+    def _event(self, kind, doff, center, start):
+        key = (kind, doff, center, start)
+        event = self._events.get(key)
+        if event is not None:
+            return event
+        with self._lock:
+            self._obs.date = start
+            self._obs.horizon = str(doff)
+            if kind == 'rise':
+                method = self._obs.next_rising
+            else:
+                method = self._obs.next_setting
+            if center:
+                event = method(self._orb, use_center=True).datetime()
+            else:
+                event = method(self._orb).datetime()
+            if len(self._events) > self._cache_size:
+                self._events.clear()
+            self._events[key] = event
+        return event
 
     def pos(self, offset=None, degree=False, dt=None):  # offset in minutesA
         if dt is None:
-            date = datetime.datetime.utcnow()
+            date = self._clock.utcnow()
         else: 
             date = dt.replace(tzinfo=tzutc())
         if offset:
             date += dateutil.relativedelta.relativedelta(minutes=offset)
-        self._obs.date = date
-        self._orb.compute(self._obs)
+        with self._lock:
+            self._obs.date = date
+            self._orb.compute(self._obs)
+            az, alt = self._orb.az, self._orb.alt
         if degree:
-            return (math.degrees(self._orb.az), math.degrees(self._orb.alt))
+            return (math.degrees(az), math.degrees(alt))
         else:
-            return (self._orb.az, self._orb.alt)
+            return (az, alt)
 
     def _light(self, offset=None):  # offset in minutes
-        date = datetime.datetime.utcnow()
+        date = self._clock.utcnow()
         if offset:
             date += dateutil.relativedelta.relativedelta(minutes=offset)
-        self._obs.date = date
-        self._orb.compute(self._obs)
-        return int(round(self._orb.moon_phase * 100))
+        with self._lock:
+            self._obs.date = date
+            self._orb.compute(self._obs)
+            return int(round(self._orb.moon_phase * 100))
 
     def _phase(self, offset=None):  # offset in minutes
-        date = datetime.datetime.utcnow()
+        date = self._clock.utcnow()
         cycle = 29.530588861
         if offset:
             date += dateutil.relativedelta.relativedelta(minutes=offset)
-        self._obs.date = date
-        self._orb.compute(self._obs)
-        last = ephem.previous_new_moon(self._obs.date)
-        frac = (self._obs.date - last) / cycle
+        with self._lock:
+            self._obs.date = date
+            self._orb.compute(self._obs)
+            last = ephem.previous_new_moon(self._obs.date)
+            frac = (self._obs.date - last) / cycle
         return int(round(frac * 8))
@@ -20,74 +20,362 @@
 #  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
 ##########################################################################
 
+import bisect
 import gc  # noqa
+import heapq
+import itertools
 import logging
 import time
 import datetime
 import calendar
+import collections
+import contextlib
 import sys
 import traceback
 import threading
 import os  # noqa
-import random
+import random  # noqa
 import types  # noqa
 import subprocess  # noqa
 from lib.model.smartplugin import SmartPlugin
+import lib.clock
+import lib.executor
 
 import dateutil.relativedelta
-from dateutil.relativedelta import MO, TU, WE, TH, FR, SA, SU
 from dateutil.tz import tzutc
 
 logger = logging.getLogger(__name__)
 
+_utc = tzutc()
+
 class PriorityQueue:
+    """
+    Heap based priority queue, entries with the same priority are returned in insertion order.
+    get() could block until an entry is available.
+    """
 
     def __init__(self):
-        self.queue = []
+        self.queue = []  # heap of (priority, count, data)
         self.lock = threading.Lock()
+        self._not_empty = threading.Condition(self.lock)
+        self._count = itertools.count()
 
     def insert(self, priority, data):
-        self.lock.acquire()
-        lo = 0
-        hi = len(self.queue)
-        while lo < hi:
-            mid = (lo + hi) // 2
-            if priority < self.queue[mid][0]:
-                hi = mid
+        with self.lock:
+            heapq.heappush(self.queue, (priority, next(self._count), data))
+            self._not_empty.notify()
+
+    def insert_many(self, entries):
+        entries = [(priority, next(self._count), data) for priority, data in entries]
+        with self.lock:
+            if len(entries) > len(self.queue):
+                self.queue.extend(entries)
+                heapq.heapify(self.queue)
             else:
-                lo = mid + 1
-        self.queue.insert(lo, (priority, data))
-        self.lock.release()
+                for entry in entries:
+                    heapq.heappush(self.queue, entry)
+            self._not_empty.notify(len(entries))
 
-    def get(self):
-        self.lock.acquire()
-        try:
-            return self.queue.pop(0)
-        except IndexError:
-            raise
-        finally:
-            self.lock.release()
+    def get(self, block=False, timeout=None):
+        with self.lock:
+            if block:
+                self._not_empty.wait_for(lambda: self.queue, timeout)
+            priority, count, data = heapq.heappop(self.queue)  # raises IndexError if empty
+        return priority, data
+
+    def peek(self):
+        with self.lock:
+            priority, count, data = self.queue[0]  # raises IndexError if empty
+        return priority, data
 
     def qsize(self):
+        # no locking, len() of a list is atomic
         return len(self.queue)
 
 
+class RunQueue:
+    """
+    Run queue of the scheduler: one heap per prio ordered by the intended start (deadline).
+    get() returns the earliest task of the best prio. A task waiting longer than aging seconds
+    counts as one prio better per aging seconds waited, so tasks with a low prio can not starve.
+    """
+
+    def __init__(self, clock, aging=0):
+        self.clock = clock
+        self.aging = aging  # seconds per prio step, 0 for no aging
+        self.heaps = {}  # prio: heap of (deadline, count, task), only non-empty heaps
+        self.lock = threading.Lock()
+        self._not_empty = threading.Condition(self.lock)
+        self._count = itertools.count()
+        self._size = 0
+
+    def insert_many(self, tasks):
+        with self.lock:
+            for task in tasks:
+                heapq.heappush(self.heaps.setdefault(task['prio'], []), (task['deadline'], next(self._count), task))
+            self._size += len(tasks)
+            self._not_empty.notify(len(tasks))
+
+    def _best(self):
+        # the lock has to be held, raises IndexError if empty
+        if not self.heaps:
+            raise IndexError('run queue is empty')
+        now = self.clock.monotonic()
+        best = None
+        for prio, heap in self.heaps.items():
+            deadline, count, task = heap[0]
+            if self.aging:
+                prio = max(0, prio - int(max(0, now - deadline) // self.aging))
+            if best is None or (prio, deadline, count) < best[:3]:
+                best = (prio, deadline, count, heap)
+        return best[3]
+
+    def _pop(self, heap):
+        # the lock has to be held
+        deadline, count, task = heapq.heappop(heap)
+        if not heap:
+            del(self.heaps[task['prio']])
+        self._size -= 1
+        return task
+
+    def get(self, block=False, timeout=None):
+        with self.lock:
+            if block:
+                self._not_empty.wait_for(lambda: self.heaps, timeout)
+            return self._pop(self._best())
+
+    def peek(self):
+        with self.lock:
+            return self._best()[0][2]
+
+    def remove_oldest(self, match):
+        # removes and returns the task with the earliest deadline of the prios with match(prio), None if there is none
+        with self.lock:
+            heaps = [heap for prio, heap in self.heaps.items() if match(prio)]
+            if not heaps:
+                return None
+            return self._pop(min(heaps, key=lambda heap: heap[0][:2]))
+
+    def qsize(self):
+        return self._size
+
+
+class Crontab:
+    """
+    Compiled 'minute hour day wday' crontab expression.
+
+    Every field is kept as a bitmask, so the next matching time is found by bit arithmetic
+    instead of enumerating all day-hour-minute combinations. Instances are cached per
+    expression, use Crontab.get() to obtain one.
+    """
+
+    _cache = {}
+
+    @classmethod
+    def get(cls, expression):
+        crontab = cls._cache.get(expression)
+        if crontab is None:
+            crontab = cls(expression)
+            cls._cache[expression] = crontab
+        return crontab
+
+    def __init__(self, expression):
+        minute, hour, day, wday = expression.split()
+        self.expression = expression
+        self.minutes = self._mask(minute, 0, 59)
+        self.hours = self._mask(hour, 0, 23)
+        # like classic cron, day and weekday are combined if both are specified
+        if day == '*' and wday == '*':
+            self.days = self._mask('*', 1, 31)
+            self.wdays = 0
+        else:
+            self.days = 0 if day == '*' else self._mask(day, 1, 31)
+            self.wdays = 0 if wday == '*' else self._mask(wday, 0, 6)
+        if not (self.minutes and self.hours and (self.days or self.wdays)):
+            raise ValueError("Crontab {0} never matches".format(expression))
+
+    def _mask(self, entry, low, high):
+        if entry == '*':
+            return ((1 << (high + 1)) - 1) & ~((1 << low) - 1)
+        mask = 0
+        for item in entry.split(','):
+            item = int(item)
+            if item < low:
+                continue
+            if item > high:  # entry above range
+                item = high  # truncate value to highest possible
+            mask |= 1 << item
+        return mask
+
+    @staticmethod
+    def _first(mask, start):
+        # lowest bit of mask >= start or None
+        mask >>= start
+        if not mask:
+            return None
+        return start + (mask & -mask).bit_length() - 1
+
+    def _match_day(self, date):
+        if self.wdays >> date.weekday() & 1:
+            return True
+        if self.days >> date.day & 1:
+            return True
+        mdays = calendar.monthrange(date.year, date.month)[1]
+        # days beyond the end of the month are truncated to the last day
+        return date.day == mdays and self.days >> (mdays + 1) != 0
+
+    def _match_time(self, hour, minute):
+        # first (hour, minute) of the day not before the given time
+        start = hour
+        hour = self._first(self.hours, hour)
+        while hour is not None:
+            minute = self._first(self.minutes, minute if hour == start else 0)  # a later hour starts at minute 0
+            if minute is not None:
+                return hour, minute
+            hour = self._first(self.hours, hour + 1)
+        return None
+
+    def next(self, now):
+        """
+        Returns the first matching (tz aware) datetime after the minute of now or None.
+        """
+        start = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        date = start.date()
+        hour, minute = start.hour, start.minute
+        for i in range(366):
+            if self._match_day(date):
+                match = self._match_time(hour, minute)
+                if match is not None:
+                    return now.replace(year=date.year, month=date.month, day=date.day, hour=match[0], minute=match[1], second=0, microsecond=0)
+            date += datetime.timedelta(days=1)
+            hour = minute = 0
+        return None
+
+
+class ItemGroup:
+    """
+    Items with the same crontab/cycle specification, run as one scheduler job.
+    Every item gets the value of the fired crontab/cycle entry like a job of its own.
+    """
+
+    def __init__(self, name, cron, cycle, fixed_rate):
+        self.name = name
+        self.cron = cron
+        self.cycle = cycle
+        self.fixed_rate = fixed_rate
+        self.items = collections.OrderedDict()  # item path: item
+
+    def __len__(self):
+        return len(self.items)
+
+    def run(self, value):
+        # returns False if an item raised an exception
+        ok = True
+        if value is None:
+            return ok
+        for path, item in list(self.items.items()):
+            try:
+                item(value, caller="Scheduler")
+            except Exception as e:
+                logging.getLogger(path).exception("Item {0} exception: {1}".format(path, e))
+                ok = False
+        return ok
+
+
 class Scheduler(threading.Thread):
 
-    _workers = []
-    _worker_num = 5
+    _worker_num = 5  # minimum number of worker threads
     _worker_max = 20
-    _worker_delta = 60  # wait 60 seconds before adding another worker thread
-    _scheduler = {}
-    _runq = PriorityQueue()
-    _triggerq = PriorityQueue()
+    _worker_delta = 60  # wait 60 seconds before adding another worker thread above the maximum
+    _worker_grow = 1  # add a worker if a task waits longer than this (seconds) and no worker is idle
+    _worker_idle = 600  # retire workers above the minimum after being idle for this time (seconds)
+    _max_wait = 10  # upper bound for sleeping in the main loop, e.g. to check the workers
+    _latency_samples = 1000  # number of samples per priority for the latency percentiles
+    _histogram = (0.001, 0.01, 0.1, 1, 10, 60)  # upper bounds (seconds) of the wait/run time histograms
+    _prio_aging = 30  # seconds a waiting task needs to move up one prio step in the run queue (0: no aging)
+    _late_threshold = 5  # log a warning if a task starts later than this (seconds) after its intended time
+    # run queue bands: (name, lowest prio), default high-water mark and shed policy (0: unlimited)
+    _bands = (('high', 0), ('normal', 3), ('low', 6))
+    _band_limits = {'high': (0, 'reject'), 'normal': (10000, 'drop_duplicates'), 'low': (2000, 'drop_oldest')}
+    _shed_policies = ('drop_oldest', 'drop_duplicates', 'reject')
+    _concurrency = ('queue', 'skip', 'latest', 'parallel')  # policies for tasks with a name which is already running
+    _group_size = 500  # maximum number of items per item group job
+    _phase_slots = 60  # one second slots of the minute shared by the phase allocation of all cycle jobs
+    _phase_min = 10  # earliest first run (seconds) of a cycle job without offset
+    _deferred_chunk = 1000  # jobs per lock hold when calculating the first fire times of deferred()
+    _clock_step = 1  # wall clock changes (seconds) against the monotonic clock treated as a step, e.g. by NTP
 
     def __init__(self, smarthome):
         threading.Thread.__init__(self, name='Scheduler')
         logger.info('Init Scheduler')
         self._sh = smarthome
+        self.alive = False
         self._lock = threading.Lock()
-        self._runc = threading.Condition()
+        self._wakeup = threading.Condition(self._lock)
+        self._next_wakeup = None
+        self._stats_lock = threading.Lock()
+        self._latency = {}  # prio: recent enqueue-to-start delays
+        self._latency_count = {}
+        self._stats = {}  # name: run statistics, see stats()
+        self._running = {}  # name: number of running tasks
+        self._pending = {}  # name: queued task which could be coalesced
+        self._pending_lock = threading.Lock()
+        self._serial = {}  # name of a running task: deque of tasks waiting for it
+        self._serial_lock = threading.Lock()
+        self._workers = []
+        self._worker_idle_count = 0
+        self._worker_peak = 0
+        self._last_worker = 0
+        self._pool_lock = threading.Lock()
+        self._scheduler = {}
+        self._deadlines = []  # heap of (deadline, seq, name), stale entries are skipped
+        self._clock = getattr(smarthome, 'clock', None) or lib.clock.Clock()
+        self._clock_offset = self._clock.time() - self._clock.monotonic()  # wall clock (epoch) minus monotonic clock
+        self._seq = itertools.count()
+        self._runq = None  # RunQueue, created after reading the settings
+        self._triggerq = PriorityQueue()
+        self._sun_entries = {}  # crontab: parsed sunrise/sunset entry
+        self._cron_entries = {}  # tuple of crontab entries: parsed (cron, init offset, init value)
+        self._deferred = None  # (name, offset) of jobs added within deferred()
+        self._phases = [0] * self._phase_slots  # load of the cycle jobs per second of the minute
+        self._groups = {}  # (cron, cycle, fixed_rate): item group taking new items
+        self._members = {}  # item path: name of its item group job
+        self._group_count = itertools.count(1)
+        # worker pool settings from smarthome.conf
+        self._worker_num = self._config('scheduler_workers_min', self._worker_num, int)
+        self._worker_max = self._config('scheduler_workers_max', self._worker_max, int)
+        self._worker_idle = self._config('scheduler_workers_idle', self._worker_idle, float)
+        self._worker_grow = self._config('scheduler_workers_grow', self._worker_grow, float)
+        self._process_num = self._config('scheduler_processes', 2, int)
+        self._prio_aging = self._config('scheduler_prio_aging', self._prio_aging, float)
+        self._runq = RunQueue(self._clock, self._prio_aging)
+        self._late_threshold = self._config('scheduler_late_threshold', self._late_threshold, float)
+        self._process_executor = None  # created on first use
+        self._queue_lock = threading.Lock()
+        self._queue = {}  # band: queued tasks, high-water mark and shed policy, see queue()
+        for band, prio in self._bands:
+            limit, policy = self._band_limits[band]
+            limit, policy = self._config('scheduler_queue_' + band, (limit, policy), self._parse_band)
+            self._queue[band] = {'limit': limit, 'policy': policy, 'queued': 0, 'peak': 0, 'shed': 0, 'overload': False, 'names': collections.Counter()}
+
+    def _config(self, attr, default, cast):
+        value = getattr(self._sh, '_' + attr, None)
+        if value is None:
+            return default
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            logger.warning("Scheduler: invalid value {0} for {1}, using {2}".format(value, attr, default))
+            return default
+
+    def _parse_band(self, value):
+        # 'limit [policy]', e.g. '2000 drop_oldest'
+        limit, __, policy = str(value).strip().partition(' ')
+        limit = int(limit)
+        policy = policy.strip() or 'reject'
+        if limit < 0 or policy not in self._shed_policies:
+            raise ValueError(value)
+        return limit, policy
 
     def run(self):
         self.alive = True
@@ -95,62 +383,304 @@ class Scheduler(threading.Thread):
         for i in range(self._worker_num):
             self._add_worker()
         while self.alive:
-            now = self._sh.now()
-            if self._runq.qsize() > len(self._workers):
-                delta = now - self._last_worker
-                if delta.seconds > self._worker_delta:
-                    if len(self._workers) < self._worker_max:
-                        self._add_worker()
-                    else:
-                        logger.error("Needing more worker threads than the specified maximum of {0}!".format(self._worker_max))
-                        tn = {}
-                        for t in threading.enumerate():
-                            tn[t.name] = tn.get(t.name, 0) + 1
-                        logger.info('Threads: ' + ', '.join("{0}: {1}".format(k, v) for (k, v) in list(tn.items())))
-                        self._add_worker()
-            while self._triggerq.qsize() > 0:
-                try:
-                    (dt, prio), (name, obj, by, source, dest, value) = self._triggerq.get()
-                except Exception as e:
-                    logger.warning("Trigger queue exception: {0}".format(e))
-                    break
-
-                if dt < now:  # run it
-                    self._runc.acquire()
-                    self._runq.insert(prio, (name, obj, by, source, dest, value))
-                    self._runc.notify()
-                    self._runc.release()
-                else:  # put last entry back and break while loop
-                    self._triggerq.insert((dt, prio), (name, obj, by, source, dest, value))
-                    break
+            self._check_pool()
             if not self._lock.acquire(timeout=1):
                 logger.critical("Scheduler: Deadlock!")
                 continue
-            for name in self._scheduler:
-                task = self._scheduler[name]
-                if task['next'] is not None:
-                    if task['next'] < now:
-                        self._runc.acquire()
-                        self._runq.insert(task['prio'], (name, task['obj'], 'Scheduler', None, None, task['value']))
-                        self._runc.notify()
-                        self._runc.release()
-                        task['next'] = None
-                    else:
-                        continue
-                elif not task['active']:
-                    continue
-                else:
-                    if task['cron'] is None and task['cycle'] is None:
-                        continue
-                    else:
-                        self._next_time(name)
-            self._lock.release()
-            time.sleep(0.5)
+            try:
+                self._sync_clock()
+                # deadlines are kept on the monotonic clock, see _monotonic(). Read after waiting for the lock,
+                # _check_clock() would take the wait for a step of the wall clock.
+                now = self._clock.monotonic()
+                self._check_clock(now)
+                trigger_next = self._trigger_due(now)
+                self._schedule_due(now)
+                self._wait(now, trigger_next)
+            finally:
+                self._lock.release()
 
     def stop(self):
         self.alive = False
+        if self._lock.acquire(timeout=1):
+            self._wakeup.notify()
+            self._lock.release()
+        if self._process_executor is not None:
+            self._process_executor.stop()
+
+    def _monotonic(self, dt):
+        # convert a timezone aware datetime to the monotonic clock of the deadlines
+        return lib.clock.timestamp(dt) - self._clock_offset
+
+    def _sync_clock(self):
+        # sh.clock could be replaced after the scheduler was created, e.g. by a VirtualClock for simulate():
+        # the deadlines keep their distance to now on the new monotonic clock, crontab entries are calculated again
+        # the lock has to be held
+        clock = getattr(self._sh, 'clock', None)
+        if clock is None or clock is self._clock:
+            return
+        shift = clock.monotonic() - self._clock.monotonic()
+        self._clock = clock
+        self._clock_offset = clock.time() - clock.monotonic()
+        self._runq.clock = clock
+        for orb in (getattr(self._sh, 'sun', None), getattr(self._sh, 'moon', None)):
+            if orb:
+                orb.set_clock(clock)  # sunrise/sunset entries are calculated on the new clock below
+        self._deadlines = [(deadline + shift, seq, name) for deadline, seq, name in self._deadlines]  # the order is kept
+        with self._triggerq.lock:
+            self._triggerq.queue = [((deadline + shift, prio), count, data) for (deadline, prio), count, data in self._triggerq.queue]
+        deadlines = dict((name, deadline) for deadline, seq, name in self._deadlines if name in self._scheduler and self._scheduler[name]['seq'] == seq)
+        for name, job in list(self._scheduler.items()):
+            if job['next'] is None:
+                continue
+            if job['cron'] is not None:
+                self._next_time(name)
+            elif name in deadlines:
+                job['next'] = datetime.datetime.fromtimestamp(deadlines[name] + self._clock_offset, _utc)
+
+    def _check_clock(self, now):
+        # the wall clock was set (NTP on a system without RTC, manual change): deadlines of cycles and delayed
+        # triggers are relative and stay untouched, crontab and sun based jobs are calculated again
+        # the lock has to be held
+        offset = self._clock.time() - now
+        step = offset - self._clock_offset
+        if abs(step) <= self._clock_step:
+            return
+        logger.warning("Scheduler: wall clock changed by {0:.1f} seconds, recalculating crontab entries".format(step))
+        self._clock_offset = offset
+        for name, job in list(self._scheduler.items()):
+            if job['next'] is None:
+                continue
+            if job['cron'] is not None:
+                self._next_time(name)
+            else:
+                job['next'] += datetime.timedelta(seconds=round(step))  # for display only
+
+    def _wait(self, now, trigger_next):
+        # sleep until the earliest deadline, add/change/trigger wake us up earlier if needed
+        wakeup = now + self._max_wait
+        if self._deadlines and self._deadlines[0][0] < wakeup:
+            wakeup = self._deadlines[0][0]
+        if trigger_next is not None and trigger_next < wakeup:
+            wakeup = trigger_next
+        self._next_wakeup = wakeup
+        timeout = wakeup - self._clock.monotonic()
+        if timeout > 0 and self.alive:
+            self._wakeup.wait(timeout)
+        self._next_wakeup = None
+
+    def _notify(self, deadline):
+        # the lock has to be held
+        if self._next_wakeup is not None and deadline < self._next_wakeup:
+            self._next_wakeup = deadline
+            self._wakeup.notify()
+
+    def _trigger_due(self, now):
+        # move due triggers to the run queue and return the deadline of the next one
+        due = []
+        while True:
+            try:
+                (deadline, prio), task = self._triggerq.peek()
+            except IndexError:
+                deadline = None
+                break
+            except Exception as e:
+                logger.warning("Trigger queue exception: {0}".format(e))
+                deadline = None
+                break
+            if deadline > now:
+                break
+            self._triggerq.get()
+            due.append((prio, task, deadline))
+        self._enqueue(due)
+        return deadline
+
+    def _enqueue(self, entries, coalesce=False):
+        # put (prio, (name, obj, by, source, dest, value), deadline) entries to the run queue, waiting workers are woken up
+        # deadline is the intended start (monotonic clock) or None for now, the queue is ordered by prio and deadline
+        # with coalesce a still pending task of the same name gets the new arguments instead of queuing another one
+        if not entries:
+            return
+        enqueued = self._clock.monotonic()
+        tasks = []
+        for prio, (name, obj, by, source, dest, value), deadline in entries:
+            if deadline is None:
+                deadline = enqueued
+            concurrency = getattr(obj, 'concurrency', 'queue')  # a logic attribute
+            if concurrency not in self._concurrency:
+                concurrency = 'queue'
+            if coalesce:
+                with self._pending_lock:
+                    task = self._pending.get(name)
+                    if task is not None:
+                        task.update(by=by, source=source, dest=dest, value=value)
+                        self._record_coalesced(name)
+                        continue
+                    task = {'name': name, 'obj': obj, 'by': by, 'source': source, 'dest': dest, 'value': value, 'prio': prio, 'enqueued': enqueued, 'deadline': deadline, 'coalesce': True, 'concurrency': concurrency}
+                    self._pending[name] = task
+            else:
+                task = {'name': name, 'obj': obj, 'by': by, 'source': source, 'dest': dest, 'value': value, 'prio': prio, 'enqueued': enqueued, 'deadline': deadline, 'coalesce': False, 'concurrency': concurrency}
+            if not self._admit(task, tasks):
+                self._release_pending(task)
+                continue
+            tasks.append(task)
+        self._runq.insert_many(tasks)
+        if not self._worker_idle_count:
+            self._check_pool()
+
+    def _band(self, prio):
+        name = self._bands[0][0]
+        for band, lowest in self._bands:
+            if prio >= lowest:
+                name = band
+        return name
+
+    def _admit(self, task, batch):
+        # account the task to its band, returns False if it is shed because the band is full
+        # batch: admitted tasks of the current _enqueue() which are not in the run queue yet
+        name = self._band(task['prio'])
+        band = self._queue[name]
+        with self._queue_lock:
+            if band['limit'] and band['queued'] >= band['limit']:
+                if band['policy'] == 'drop_oldest':
+                    # removed from the run queue (or the batch), so the queue is bounded by the limit
+                    shed = self._runq.remove_oldest(lambda prio: self._band(prio) == name)
+                    if shed is None:
+                        queued = [queued for queued in batch if self._band(queued['prio']) == name]
+                        if queued:
+                            shed = min(queued, key=lambda queued: queued['deadline'])
+                            batch.remove(shed)
+                    if shed is not None:
+                        band['queued'] -= 1
+                        band['names'][shed['name']] -= 1
+                        if not band['names'][shed['name']]:
+                            del(band['names'][shed['name']])
+                else:  # reject new tasks, with drop_duplicates tasks which are already queued (up to twice the limit)
+                    if band['policy'] == 'reject' or band['names'][task['name']] or band['queued'] >= 2 * band['limit']:
+                        shed = task
+                    else:
+                        shed = None
+                if shed is not None:
+                    band['shed'] += 1
+                    if not band['overload']:
+                        band['overload'] = True
+                        logger.warning("Scheduler: run queue limit of {0} tasks reached, shedding tasks ({1}), e.g. {2}".format(band['limit'], band['policy'], shed['name']))
+                    if shed is task:
+                        return False
+                    self._release_pending(shed)
+            band['queued'] += 1
+            band['names'][task['name']] += 1
+            if band['queued'] > band['peak']:
+                band['peak'] = band['queued']
+        return True
+
+    def _dequeue(self, task):
+        # a task was taken from the run queue
+        band = self._queue[self._band(task['prio'])]
+        with self._queue_lock:
+            band['queued'] -= 1
+            band['names'][task['name']] -= 1
+            if not band['names'][task['name']]:
+                del(band['names'][task['name']])
+            if band['overload'] and band['queued'] < band['limit'] // 2:
+                band['overload'] = False
+                logger.info("Scheduler: run queue below {0} tasks again, {1} tasks shed so far".format(band['limit'] // 2, band['shed']))
+
+    def queue(self):
+        """
+        Returns the state of the run queue per priority band: number of queued tasks,
+        high-water mark (limit, 0 for unlimited) with the shed policy, peak and number of shed tasks.
+        """
+        with self._queue_lock:
+            return dict((band, {'queued': state['queued'], 'limit': state['limit'], 'policy': state['policy'], 'peak': state['peak'], 'shed': state['shed']})
+                        for band, state in self._queue.items())
+
+    def _schedule_due(self, now):
+        # only the jobs at the top of the deadline heap are touched, the lock has to be held
+        due = []
+        fired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, seq, name = heapq.heappop(self._deadlines)
+            job = self._scheduler.get(name)
+            if job is None or job['seq'] != seq:  # removed or changed in the meantime
+                continue
+            job['next'] = None
+            fired.append((name, deadline))
+            if job['fixed_rate'] and name in self._running:  # skip this run instead of piling up
+                self._record_skipped(name, 1)
+                continue
+            self._check_overrun(name)
+            due.append((job['prio'], (name, job['obj'], 'Scheduler', None, None, job['value']), deadline))
+        self._enqueue(due)
+        for name, deadline in fired:  # reschedule after the loop, so a job fires at most once per pass
+            job = self._scheduler[name]
+            if job['next'] is None and job['active']:
+                if job['fixed_rate'] and job['cron'] is None and job['cycle'] is not None:
+                    self._next_fixed(name, deadline, now)
+                else:
+                    self._next_time(name)
+
+    def _next_fixed(self, name, deadline, now):
+        # fixed rate: the next run is one period after the last scheduled one, missed periods are skipped
+        job = self._scheduler[name]
+        period = list(job['cycle'].keys())[0]
+        deadline += period
+        if deadline <= now:
+            missed = int((now - deadline) // period) + 1
+            deadline += missed * period
+            self._record_skipped(name, missed)
+        job['next'] = datetime.datetime.fromtimestamp(deadline + self._clock_offset, _utc)
+        self._push(name, deadline)
+
+    def simulate(self, seconds, execute=True):
+        """
+        Runs the schedule of the next seconds on a virtual clock (sh.clock = lib.clock.VirtualClock(),
+        also after the scheduler was created) without waiting: the clock jumps from deadline to deadline
+        and the due tasks are run in the calling thread, with execute=False they are only recorded.
+        The scheduler thread must not be running. Returns the list of (datetime, task name) of the
+        started tasks.
+        """
+        with self._lock:
+            self._sync_clock()
+        if not self._clock.virtual:
+            raise ValueError("Scheduler.simulate() needs a virtual clock")
+        end = self._clock.monotonic() + seconds
+        runs = []
+        while True:
+            with self._lock:
+                now = self._clock.monotonic()
+                self._check_clock(now)
+                next_deadline = self._trigger_due(now)
+                self._schedule_due(now)
+                if self._deadlines and (next_deadline is None or self._deadlines[0][0] < next_deadline):
+                    next_deadline = self._deadlines[0][0]
+            while self._runq.qsize():  # tasks may trigger other tasks
+                task = self._runq.get()
+                self._dequeue(task)
+                runs.append((self._sh.now(), task['name']))
+                if execute:
+                    self._dispatch(task)
+                else:
+                    self._release_pending(task)
+            if next_deadline is None or next_deadline > end:
+                break
+            self._clock.advance_to(next_deadline)
+        self._clock.advance_to(end)
+        return runs
 
-    def trigger(self, name, obj=None, by='Logic', source=None, value=None, dest=None, prio=3, dt=None):
+    def _push(self, name, deadline=None):
+        # (re)insert the job into the deadline heap, older entries of this job get stale
+        job = self._scheduler[name]
+        job['seq'] = next(self._seq)
+        if job['next'] is not None:
+            if deadline is None:
+                deadline = self._monotonic(job['next'])
+            heapq.heappush(self._deadlines, (deadline, job['seq'], name))
+            self._notify(deadline)
+        if len(self._deadlines) > 2 * len(self._scheduler) + 64:  # drop stale entries
+            self._deadlines = [entry for entry in self._deadlines if entry[2] in self._scheduler and self._scheduler[entry[2]]['seq'] == entry[1]]
+            heapq.heapify(self._deadlines)
+
+    def trigger(self, name, obj=None, by='Logic', source=None, value=None, dest=None, prio=3, dt=None, coalesce=False):
         if obj is None:
             if name in self._scheduler:
                 obj = self._scheduler[name]['obj']
@@ -163,10 +693,7 @@ class Scheduler(threading.Thread):
                 return
         if dt is None:
             logger.debug("Triggering {0} - by: {1} source: {2} dest: {3} value: {4}".format(name, by, source, dest, str(value)[:40]))
-            self._runc.acquire()
-            self._runq.insert(prio, (name, obj, by, source, dest, value))
-            self._runc.notify()
-            self._runc.release()
+            self._enqueue([(prio, (name, obj, by, source, dest, value), None)], coalesce)
         else:
             if not isinstance(dt, datetime.datetime):
                 logger.warning("Trigger: Not a valid timezone aware datetime for {0}. Ignoring.".format(name))
@@ -175,54 +702,163 @@ class Scheduler(threading.Thread):
                 logger.warning("Trigger: Not a valid timezone aware datetime for {0}. Ignoring.".format(name))
                 return
             logger.debug("Triggering {0} - by: {1} source: {2} dest: {3} value: {4} at: {5}".format(name, by, source, dest, str(value)[:40], dt))
-            self._triggerq.insert((dt, prio), (name, obj, by, source, dest, value))
+            deadline = self._monotonic(dt)
+            with self._lock:
+                self._triggerq.insert((deadline, prio), (name, obj, by, source, dest, value))
+                self._notify(deadline)
 
     def remove(self, name):
         self._lock.acquire()
-        if name in self._scheduler:
-            del(self._scheduler[name])
+        if name in self._members:
+            self._leave_group(name)
+        elif name in self._scheduler:
+            self._release_phase(name)
+            del(self._scheduler[name])  # the entry in the deadline heap is dropped lazily
         self._lock.release()
 
     def return_next(self, name):
+        name = self._members.get(name, name)
         if name in self._scheduler:
             return self._scheduler[name]['next']
 
-    def add(self, name, obj, prio=3, cron=None, cycle=None, value=None, offset=None, next=None):
-        self._lock.acquire()
+    def add_item(self, name, item, cron=None, cycle=None, fixed_rate=False):
+        """
+        Adds the crontab/cycle job of an item. Items with the same specification are run
+        together by one item group job (up to _group_size items per group).
+        """
         if isinstance(cron, str):
             cron = [cron, ]
-        if isinstance(cron, list):
-            _cron = {}
-            for entry in cron:
-                desc, __, _value = entry.partition('=')
-                desc = desc.strip()
-                if _value == '':
-                    _value = None
+        if cron is not None and any(entry.strip().startswith('init') for entry in cron):  # the init run is per item
+            self.add(name, item, cron=cron, cycle=cycle, fixed_rate=fixed_rate)
+            return
+        key = (None if cron is None else tuple(cron), cycle, fixed_rate)
+        with self._lock:
+            if name in self._members:
+                self._leave_group(name)
+            group = self._groups.get(key)
+            if group is None or len(group) >= self._group_size:
+                group = ItemGroup('Items {0}'.format(next(self._group_count)), cron, cycle, fixed_rate)
+                self._groups[key] = group
+                self._add(group.name, group, cron=cron, cycle=cycle, weight=0, fixed_rate=fixed_rate)
+                if group.name not in self._scheduler:  # invalid specification
+                    del(self._groups[key])
+                    return
+            group.items[name] = item
+            self._members[name] = group.name
+            self._change_weight(group.name, 1)
+
+    def _leave_group(self, name):
+        # the lock has to be held, returns the item
+        group = self._scheduler[self._members.pop(name)]['obj']
+        item = group.items.pop(name)
+        self._change_weight(group.name, -1)
+        if not len(group):
+            self._release_phase(group.name)
+            del(self._scheduler[group.name])
+            key = (None if group.cron is None else tuple(group.cron), group.cycle, group.fixed_rate)
+            if self._groups.get(key) is group:
+                del(self._groups[key])
+        return item
+
+    def groups(self):
+        """
+        Returns the item group jobs with their crontab/cycle specification and number of items.
+        """
+        with self._lock:
+            return dict((name, {'cron': job['obj'].cron, 'cycle': job['obj'].cycle, 'fixed_rate': job['obj'].fixed_rate, 'items': len(job['obj'])})
+                        for name, job in self._scheduler.items() if isinstance(job['obj'], ItemGroup))
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """
+        Jobs added within this context get their first fire time calculated in one pass
+        when the context is left, e.g. for the crontab and cycle entries of all items at startup.
+        """
+        if self._deferred is not None:  # nested
+            yield
+            return
+        self._deferred = []
+        try:
+            yield
+        finally:
+            with self._lock:
+                jobs, self._deferred = self._deferred, None
+            now = self._sh.now()
+            crontabs = {}  # crontab entry: next time, calculated once per entry
+            for start in range(0, len(jobs), self._deferred_chunk):
+                # the lock is released between the chunks, so the running main loop and workers are not blocked
+                with self._lock:
+                    for name, offset in jobs[start:start + self._deferred_chunk]:
+                        if name in self._scheduler and self._scheduler[name]['next'] is None:
+                            if offset is None and self._scheduler[name]['phase'] is not None:
+                                offset = self._phase_offset(name, now)
+                            self._next_time(name, offset, now, crontabs)
+                time.sleep(0)
+            logger.debug("Scheduler: calculated first fire time of {0} jobs".format(len(jobs)))
+
+    def add_many(self, jobs):
+        """
+        Adds a list of jobs, each given as a dict of add() arguments.
+        """
+        with self.deferred():
+            for job in jobs:
+                self.add(**job)
+
+    def _parse_cron(self, cron):
+        # returns (cron dict or None, init offset or None, init value), cached per list of entries
+        key = tuple(cron)
+        if key in self._cron_entries:
+            return self._cron_entries[key]
+        _cron = {}
+        offset = None
+        value = None
+        for entry in cron:
+            desc, __, _value = entry.partition('=')
+            desc = desc.strip()
+            if _value == '':
+                _value = None
+            else:
+                _value = _value.strip()
+            if desc.startswith('init'):
+                offset = 5  # default init offset
+                desc, op, seconds = desc.partition('+')
+                if op:
+                    offset += int(seconds)
                 else:
-                    _value = _value.strip()
-                if desc.startswith('init'):
-                    offset = 5  # default init offset
-                    desc, op, seconds = desc.partition('+')
+                    desc, op, seconds = desc.partition('-')
                     if op:
-                        offset += int(seconds)
-                    else:
-                        desc, op, seconds = desc.partition('-')
-                        if op:
-                            offset -= int(seconds)
-                    value = _value
-                    next = self._sh.now() + datetime.timedelta(seconds=offset)
-                else:
-                    _cron[desc] = _value
-            if _cron == {}:
-                cron = None
+                        offset -= int(seconds)
+                value = _value
             else:
-                cron = _cron
-        if isinstance(cycle, int):
+                _cron[desc] = _value
+        result = (_cron or None, offset, value)
+        self._cron_entries[key] = result
+        return result
+
+    def add(self, name, obj, prio=3, cron=None, cycle=None, value=None, offset=None, next=None, weight=1, fixed_rate=False):
+        with self._lock:
+            self._add(name, obj, prio, cron, cycle, value, offset, next, weight, fixed_rate)
+
+    def _add(self, name, obj, prio=3, cron=None, cycle=None, value=None, offset=None, next=None, weight=1, fixed_rate=False):
+        # the lock has to be held
+        if isinstance(cron, str):
+            cron = [cron, ]
+        if isinstance(cron, list):
+            cron, init, init_value = self._parse_cron(cron)
+            if init is not None:
+                offset = init
+                value = init_value
+                next = self._sh.now() + datetime.timedelta(seconds=offset)
+        if isinstance(cycle, (int, float)):
             cycle = {cycle: None}
         elif isinstance(cycle, str):
             cycle, __, _value = cycle.partition('=')
             try:
-                cycle = int(cycle.strip())
+                cycle = float(cycle.strip())
+                if cycle.is_integer():
+                    cycle = int(cycle)
+                if cycle <= 0:
+                    raise ValueError(cycle)
             except Exception:
                 logger.warning("Scheduler: invalid cycle entry for {0} {1}".format(name, cycle))
                 return
@@ -231,26 +867,41 @@ class Scheduler(threading.Thread):
             else:
                 _value = None
             cycle = {cycle: _value}
-        if cycle is not None and offset is None:  # spread cycle jobs
-                offset = random.randint(10, 15)
         # change name for multi instance plugins 
         if obj.__class__.__name__ == 'method':
             if isinstance(obj.__self__, SmartPlugin):
                 if obj.__self__.get_instance_name() != '':
                     name = name +'_'+ obj.__self__.get_instance_name()
                     logger.debug("Scheduler: Name changed by adding plugin instance name to: " + name)
-        self._scheduler[name] = {'prio': prio, 'obj': obj, 'cron': cron, 'cycle': cycle, 'value': value, 'next': next, 'active': True}
-        if next is None:
+        if name in self._scheduler:
+            self._release_phase(name)
+        self._scheduler[name] = {'prio': prio, 'obj': obj, 'cron': cron, 'cycle': cycle, 'value': value, 'next': next, 'active': True, 'seq': None, 'phase': None, 'fixed_rate': fixed_rate}
+        if cycle is not None and offset is None:  # spread cycle jobs over the period
+            self._allocate_phase(name, list(cycle.keys())[0], weight)
+            if self._deferred is None:
+                offset = self._phase_offset(name, self._sh.now())
+        if next is None and self._deferred is not None:
+            self._deferred.append((name, offset))
+        elif next is None:
             self._next_time(name, offset)
-        self._lock.release()
+        else:
+            self._push(name)
 
     def get( self, name):
+        name = self._members.get(name, name)
         if name in self._scheduler:
             return self._scheduler[name]
         else:
             return None
 
     def change(self, name, **kwargs):
+        with self._lock:
+            self._change(name, **kwargs)
+
+    def _change(self, name, **kwargs):
+        if name in self._members:  # the item gets a job of its own
+            group = self._scheduler[self._members[name]]['obj']
+            self._add(name, self._leave_group(name), cron=group.cron, cycle=group.cycle, fixed_rate=group.fixed_rate)
         if name in self._scheduler:
             for key in kwargs:
                 if key in self._scheduler[name]:
@@ -277,32 +928,51 @@ class Scheduler(threading.Thread):
                     self._scheduler[name][key] = kwargs[key]
                 else:
                     logger.warning("Attribute {0} for {1} not specified. Could not change it.".format(key, name))
+            offset = None
+            if 'cycle' in kwargs:  # move the job to a slot of the new period
+                phase = self._scheduler[name]['phase']
+                self._release_phase(name)
+                if isinstance(self._scheduler[name]['cycle'], dict):
+                    self._allocate_phase(name, list(self._scheduler[name]['cycle'].keys())[0], 1 if phase is None else phase[2])
+                    offset = self._phase_offset(name, self._sh.now())
             if self._scheduler[name]['active'] is True:
-                if 'cycle' in kwargs or 'cron' in kwargs:
-                    self._next_time(name)
+                if 'cycle' in kwargs or 'cron' in kwargs or self._scheduler[name]['next'] is None:
+                    self._next_time(name, offset)
+                else:
+                    self._push(name)
             else:
                 self._scheduler[name]['next'] = None
+                self._push(name)
         else:
             logger.warning("Could not change {0}. No logic/method with this name found.".format(name))
 
-    def _next_time(self, name, offset=None):
+    def _next_time(self, name, offset=None, now=None, crontabs=None):
+        # crontabs could be a dict to share the next time of crontab entries between jobs (for the same now)
         job = self._scheduler[name]
         if None == job['cron'] == job['cycle']:
             self._scheduler[name]['next'] = None
+            self._push(name)
             return
         next_time = None
         value = None
-        now = self._sh.now()
-        now = now.replace(microsecond=0)
+        if now is None:
+            now = self._sh.now()
         if job['cycle'] is not None:
             cycle = list(job['cycle'].keys())[0]
             value = job['cycle'][cycle]
             if offset is None:
                 offset = cycle
+            if isinstance(cycle, int):  # fractional cycles keep the sub-second part
+                now = now.replace(microsecond=0)
             next_time = now + datetime.timedelta(seconds=offset)
         if job['cron'] is not None:
             for entry in job['cron']:
-                ct = self._crontab(entry)
+                if crontabs is None:
+                    ct = self._crontab(entry)
+                elif entry in crontabs:
+                    ct = crontabs[entry]
+                else:
+                    ct = crontabs[entry] = self._crontab(entry)
                 if next_time is not None:
                     if ct < next_time:
                         next_time = ct
@@ -312,6 +982,7 @@ class Scheduler(threading.Thread):
                     value = job['cron'][entry]
         self._scheduler[name]['next'] = next_time
         self._scheduler[name]['value'] = value
+        self._push(name)
         if name not in ['Connections', 'series', 'SQLite dump']:
             logger.debug("{0} next time: {1}".format(name, next_time))
 
@@ -319,11 +990,105 @@ class Scheduler(threading.Thread):
         for job in self._scheduler:
             yield job
 
+    def _phase_pattern(self, period, slot):
+        # (slot, load) of a job with weight 1 on the shared table: a job with a period below a minute
+        # runs in several slots, a longer one adds its average runs per minute to its slot
+        base = self._phase_slots
+        if period >= base:
+            return [(slot, base / period)]
+        return [(int(slot + run * period) % base, 1) for run in range(int(base // period))]
+
+    def _allocate_phase(self, name, period, weight):
+        # assign the slot with the least load of the runs of the job, among equally loaded slots the one
+        # farthest away from higher loaded slots, so the jobs of all periods are spread evenly over the minute
+        # the lock has to be held
+        if period <= 0:
+            return
+        slots = self._phases
+        count = len(slots)
+        costs = [round(sum(slots[i] for i, load in self._phase_pattern(period, slot)), 9) for slot in range(count)]
+        low = min(costs)
+        distance = [0 if round(load, 9) > 0 else count for load in slots]
+        for i in list(range(count)) * 2:  # forward and backward sweep of the circular distance
+            distance[i] = min(distance[i], distance[i - 1] + 1)
+        for i in list(reversed(range(count))) * 2:
+            distance[i] = min(distance[i], distance[(i + 1) % count] + 1)
+        slot = max((i for i in range(count) if costs[i] == low), key=lambda i: (distance[i], -i))
+        self._scheduler[name]['phase'] = (period, slot, 0)
+        self._change_weight(name, weight)
+
+    def _change_weight(self, name, delta):
+        # the lock has to be held
+        phase = self._scheduler[name]['phase']
+        if phase is None:
+            return
+        period, slot, weight = phase
+        for i, load in self._phase_pattern(period, slot):
+            self._phases[i] += load * delta
+        self._scheduler[name]['phase'] = (period, slot, weight + delta)
+
+    def _release_phase(self, name):
+        # the lock has to be held
+        phase = self._scheduler[name].get('phase')
+        if phase is None:
+            return
+        self._change_weight(name, -phase[2])
+        self._scheduler[name]['phase'] = None
+
+    def _phase_offset(self, name, now):
+        # seconds until the first run of the job in its slot: at least _phase_min, within min(period, 60 s) after it
+        period, slot, weight = self._scheduler[name]['phase']
+        base = min(period, self._phase_slots)
+        offset = (slot - lib.clock.timestamp(now.replace(microsecond=0))) % base  # _next_time() starts at the full second
+        while offset < self._phase_min:
+            offset += base
+        return offset
+
+    def load_profile(self):
+        """
+        Returns the phase allocation of the cycle jobs as a list of (second of the minute,
+        load), the load is the summed weight of the runs of the jobs in this second per minute.
+        """
+        with self._lock:
+            return [(slot, round(load, 3)) for slot, load in enumerate(self._phases)]
+
+    def _check_pool(self):
+        # add a worker if the next task in the run queue waits too long and no worker is idle
+        if self._worker_idle_count or not self._runq.qsize() or not self.alive:
+            return
+        try:
+            task = self._runq.peek()
+        except IndexError:
+            return
+        now = lib.clock.monotonic()
+        if self._clock.monotonic() - task['enqueued'] < self._worker_grow or now - self._last_worker < self._worker_grow:
+            return
+        if not self._pool_lock.acquire(False):  # somebody else is checking
+            return
+        try:
+            if len(self._workers) >= self._worker_max:
+                if now - self._last_worker < self._worker_delta:
+                    return
+                logger.error("Needing more worker threads than the specified maximum of {0}!".format(self._worker_max))
+                tn = {}
+                for t in threading.enumerate():
+                    tn[t.name] = tn.get(t.name, 0) + 1
+                logger.info('Threads: ' + ', '.join("{0}: {1}".format(k, v) for (k, v) in list(tn.items())))
+            self._start_worker()
+        finally:
+            self._pool_lock.release()
+
     def _add_worker(self):
-        self._last_worker = self._sh.now()
+        with self._pool_lock:
+            self._start_worker()
+
+    def _start_worker(self):
+        # the pool lock has to be held
+        self._last_worker = lib.clock.monotonic()
         t = threading.Thread(target=self._worker)
-        t.start()
         self._workers.append(t)
+        self._worker_peak = max(self._worker_peak, len(self._workers))
+        t.start()
         if len(self._workers) > self._worker_num:
             logger.info("Adding worker thread. Total: {0}".format(len(self._workers)))
             tn = {}
@@ -332,21 +1097,232 @@ class Scheduler(threading.Thread):
             logger.info('Threads: ' + ', '.join("{0}: {1}".format(k, v) for (k, v) in list(tn.items())))
 
     def _worker(self):
+        idle_since = lib.clock.monotonic()
         while self.alive:
-            self._runc.acquire()
-            self._runc.wait(timeout=1)
+            with self._pool_lock:
+                self._worker_idle_count += 1
             try:
-                prio, (name, obj, by, source, dest, value) = self._runq.get()
+                task = self._runq.get(block=True, timeout=1)
             except IndexError:
+                if lib.clock.monotonic() - idle_since > self._worker_idle and self._retire_worker():
+                    return
                 continue
             finally:
-                self._runc.release()
-            self._task(name, obj, by, source, dest, value)
+                with self._pool_lock:
+                    self._worker_idle_count -= 1
+            self._execute(task)
+            idle_since = lib.clock.monotonic()
+
+    def _retire_worker(self):
+        with self._pool_lock:
+            if len(self._workers) <= self._worker_num:
+                return False
+            self._workers.remove(threading.current_thread())
+            logger.info("Removing idle worker thread. Total: {0}".format(len(self._workers)))
+            return True
+
+    def workers(self):
+        """
+        Returns the state of the worker pool: current size, busy and idle workers,
+        high-water mark and the configured minimum and maximum.
+        """
+        with self._pool_lock:
+            size = len(self._workers)
+            idle = self._worker_idle_count
+        return {'size': size, 'busy': size - idle, 'idle': idle, 'peak': self._worker_peak, 'min': self._worker_num, 'max': self._worker_max}
+
+    def _execute(self, task):
+        # run a task taken from the run queue
+        self._dequeue(task)
+        self._dispatch(task)
+
+    def _dispatch(self, task):
+        # tasks with the same name run one at a time in their order: a task is parked while another one
+        # of its name is running and run by the same worker afterwards (depending on the concurrency policy)
+        name = task['name']
+        if not self._worker_idle_count:  # the queue may be growing
+            self._check_pool()
+        if task['concurrency'] == 'parallel':
+            self._run(task)
+            return
+        skipped = []
+        with self._serial_lock:
+            if name in self._serial:
+                waiting = self._serial[name]
+                if task['concurrency'] == 'skip':
+                    skipped.append(task)
+                elif task['concurrency'] == 'latest':  # replaces the waiting tasks
+                    skipped.extend(waiting)
+                    waiting.clear()
+                    waiting.append(task)
+                else:
+                    if task['by'] == 'Scheduler':  # an overrunning cron/cycle job waits at most once, with its latest run
+                        for entry in waiting:
+                            if entry['by'] == 'Scheduler':
+                                waiting.remove(entry)
+                                skipped.append(entry)
+                                break
+                    waiting.append(task)
+                task = None
+            else:
+                self._serial[name] = collections.deque()
+        if task is None:
+            if skipped:
+                for entry in skipped:
+                    self._release_pending(entry)
+                self._record_skipped(name, len(skipped))
+            return
+        try:
+            while task is not None:
+                self._run(task)
+                with self._serial_lock:
+                    if self._serial[name]:
+                        task = self._serial[name].popleft()
+                    else:
+                        del(self._serial[name])
+                        task = None
+        finally:
+            if task is not None:  # _run() raised, later tasks of the name must not wait forever
+                with self._serial_lock:
+                    waiting = self._serial.pop(name, ())
+                for entry in waiting:
+                    self._release_pending(entry)
+                if waiting:
+                    self._record_skipped(name, len(waiting))
+
+    def _release_pending(self, task):
+        # no more updates of a coalesced task from now on
+        if task['coalesce']:
+            with self._pending_lock:
+                if self._pending.get(task['name']) is task:
+                    del(self._pending[task['name']])
+
+    def _run(self, task):
+        name = task['name']
+        self._release_pending(task)
+        start = self._clock.monotonic()
+        self._record_latency(task['prio'], start - task['enqueued'])
+        lateness = max(0.0, start - task['deadline'])
+        if lateness > self._late_threshold:
+            logger.warning("Scheduler: {0} started {1:.1f} seconds late".format(name, lateness))
+        with self._stats_lock:
+            self._running[name] = self._running.get(name, 0) + 1
+        run_start = lib.clock.monotonic()  # execution time is measured on the real clock, also in simulations
+        ok = False
+        try:
+            ok = self._task(name, task['obj'], task['by'], task['source'], task['dest'], task['value'])
+        except Exception as e:
+            logger.exception("Scheduler: {0} exception: {1}".format(name, e))
+        finally:
+            threading.current_thread().name = 'idle'
+            self._record_run(name, start - task['enqueued'], lib.clock.monotonic() - run_start, ok, lateness)
+
+    def _record_run(self, name, wait, duration, ok, lateness=0.0):
+        with self._stats_lock:
+            self._running[name] -= 1
+            if not self._running[name]:
+                del(self._running[name])
+            stats = self._task_stats(name)
+            stats['runs'] += 1
+            if not ok:
+                stats['exceptions'] += 1
+            stats['last'] = duration
+            if duration > stats['max']:
+                stats['max'] = duration
+            stats['total'] += duration
+            if lateness > self._late_threshold:
+                stats['late'] += 1
+            if lateness > stats['lateness_max']:
+                stats['lateness_max'] = lateness
+            stats['lateness'][bisect.bisect_left(self._histogram, lateness)] += 1
+            stats['wait'][bisect.bisect_left(self._histogram, wait)] += 1
+            stats['time'][bisect.bisect_left(self._histogram, duration)] += 1
+
+    def _task_stats(self, name):
+        # the stats lock has to be held
+        if name not in self._stats:
+            self._stats[name] = {'runs': 0, 'exceptions': 0, 'overruns': 0, 'coalesced': 0, 'late': 0, 'skipped': 0, 'last': None, 'max': 0.0, 'total': 0.0, 'lateness_max': 0.0,
+                                 'wait': [0] * (len(self._histogram) + 1), 'time': [0] * (len(self._histogram) + 1), 'lateness': [0] * (len(self._histogram) + 1)}
+        return self._stats[name]
+
+    def _record_coalesced(self, name):
+        with self._stats_lock:
+            self._task_stats(name)['coalesced'] += 1
+
+    def _record_skipped(self, name, count):
+        with self._stats_lock:
+            self._task_stats(name)['skipped'] += count
+        logger.debug("Scheduler: {0} skipped {1} run(s)".format(name, count))
+
+    def _check_overrun(self, name):
+        # a scheduled job is due again, but its last run has not finished yet
+        with self._stats_lock:
+            if name not in self._running:
+                return
+            self._task_stats(name)['overruns'] += 1
+        logger.warning("Scheduler: {0} is due again but still running".format(name))
+
+    def stats(self, name=None):
+        """
+        Returns the run statistics per task name (or of the given task): number of runs,
+        exceptions, overruns, coalesced triggers, skipped fixed rate runs and late starts, last/max/total execution time
+        and the maximum lateness in seconds and the histograms of the queue wait, execution time
+        and lateness (start minus intended time) as lists of (upper bound, count).
+        """
+        bounds = list(self._histogram) + [float('inf')]
+        result = {}
+        with self._stats_lock:
+            for task, stats in self._stats.items():
+                if name is not None and task != name:
+                    continue
+                stats = dict(stats)
+                stats['running'] = self._running.get(task, 0)
+                stats['wait'] = list(zip(bounds, stats['wait']))
+                stats['time'] = list(zip(bounds, stats['time']))
+                stats['lateness'] = list(zip(bounds, stats['lateness']))
+                result[task] = stats
+        if name is not None:
+            return result.get(name)
+        return result
+
+    def _record_latency(self, prio, delay):
+        with self._stats_lock:
+            if prio not in self._latency:
+                self._latency[prio] = collections.deque(maxlen=self._latency_samples)
+                self._latency_count[prio] = 0
+            self._latency[prio].append(delay)
+            self._latency_count[prio] += 1
+
+    def latency(self):
+        """
+        Returns the enqueue-to-start latency of the run queue (in seconds) per priority.
+        p50/p99 are based on the most recent samples.
+        """
+        result = {}
+        with self._stats_lock:
+            latency = dict((prio, list(samples)) for prio, samples in self._latency.items())
+        for prio in sorted(latency):
+            samples = sorted(latency[prio])
+            if not samples:
+                continue
+            result[prio] = {'count': self._latency_count[prio], 'p50': samples[int(0.5 * (len(samples) - 1))], 'p99': samples[int(0.99 * (len(samples) - 1))], 'max': samples[-1]}
+        return result
 
     def _task(self, name, obj, by, source, dest, value):
         threading.current_thread().name = name
         logger = logging.getLogger(name)
-        if obj.__class__.__name__ == 'Logic':
+        ok = True
+        if obj.__class__.__name__ == 'Logic' and getattr(obj, 'executor', None) == 'process':
+            try:
+                if self._process_executor is None:
+                    with self._pool_lock:
+                        if self._process_executor is None:
+                            self._process_executor = lib.executor.ProcessExecutor(self._sh, self._process_num)
+                ok = self._process_executor.run(obj, by, source, dest, value)
+            except Exception as e:
+                logger.exception("Logic: {0}, could not run in a process: {1}".format(name, e))
+                ok = False
+        elif obj.__class__.__name__ == 'Logic':
             trigger = {'by': by, 'source': source, 'dest': dest, 'value': value}  # noqa
             logic = obj  # noqa
             sh = self._sh  # noqa
@@ -359,12 +1335,16 @@ class Scheduler(threading.Thread):
                 tb = sys.exc_info()[2]
                 tb = traceback.extract_tb(tb)[-1]
                 logger.exception("Logic: {0}, File: {1}, Line: {2}, Method: {3}, Exception: {4}".format(name, tb[0], tb[1], tb[2], e))
+                ok = False
+        elif isinstance(obj, ItemGroup):
+            ok = obj.run(value)
         elif obj.__class__.__name__ == 'Item':
             try:
                 if value is not None:
                     obj(value, caller="Scheduler")
             except Exception as e:
                 logger.exception("Item {0} exception: {1}".format(name, e))
+                ok = False
         else:  # method
             try:
                 if value is None:
@@ -373,7 +1353,9 @@ class Scheduler(threading.Thread):
                     obj(**value)
             except Exception as e:
                 logger.exception("Method {0} exception: {1}".format(name, e))
+                ok = False
         threading.current_thread().name = 'idle'
+        return ok
 
     def _crontab(self, crontab):
         try:
@@ -381,59 +1363,47 @@ class Scheduler(threading.Thread):
             for entry in crontab.split('<'):
                 if entry.startswith('sun'):
                     return self._sun(crontab)
-            next_event = self._parse_month(crontab)  # this month
-            if not next_event:
-                next_event = self._parse_month(crontab, next_month=True)  # next month
+            next_event = Crontab.get(crontab).next(self._sh.now())
+            if next_event is None:
+                raise ValueError("no matching date")
             return next_event
         except:
             logger.error("Error parsing crontab: {}".format(crontab))
             return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
 
-    def _parse_month(self, crontab, next_month=False):
-        now = self._sh.now()
-        minute, hour, day, wday = crontab.split(' ')
-        # evaluate the crontab strings
-        minute_range = self._range(minute, 00, 59)
-        hour_range = self._range(hour, 00, 23)
-        if not next_month:
-            mdays = calendar.monthrange(now.year, now.month)[1]
-        elif now.month == 12:
-            mdays = calendar.monthrange(now.year + 1, 1)[1]
-        else:
-            mdays = calendar.monthrange(now.year, now.month + 1)[1]
-        if wday == '*' and day == '*':
-            day_range = self._day_range('0, 1, 2, 3, 4, 5, 6')
-        elif wday != '*' and day == '*':
-            day_range = self._day_range(wday)
-        elif wday != '*' and day != '*':
-            day_range = self._day_range(wday)
-            day_range = day_range + self._range(day, 0o1, mdays)
-        else:
-            day_range = self._range(day, 0o1, mdays)
-        # combine the differnt ranges
-        event_range = sorted([str(day) + '-' + str(hour) + '-' + str(minute) for minute in minute_range for hour in hour_range for day in day_range])
-        if next_month:  # next month
-            next_event = event_range[0]
-            next_time = now + dateutil.relativedelta.relativedelta(months=+1)
-        else:  # this month
-            now_str = now.strftime("%d-%H-%M")
-            next_event = self._next(lambda event: event > now_str, event_range)
-            if not next_event:
-                return False
-            next_time = now
-        day, hour, minute = next_event.split('-')
-        return next_time.replace(day=int(day), hour=int(hour), minute=int(minute), second=0, microsecond=0)
-
-    def _next(self, f, seq):
-        for item in seq:
-            if f(item):
-                return item
-        return False
-
     def _sun(self, crontab):
         if not self._sh.sun:  # no sun object created
             logger.warning('No latitude/longitude specified. You could not use sunrise/sunset as crontab entry.')
             return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
+        if crontab not in self._sun_entries:
+            self._sun_entries[crontab] = self._parse_sun(crontab)
+        entry = self._sun_entries[crontab]
+        if entry is None:
+            logger.error('Wrong syntax: {0}. Should be [H:M<](sunrise|sunset)[+|-][offset][<H:M]'.format(crontab))
+            return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
+        smin, event, doff, moff, smax = entry
+
+        # the orb caches the events per day, so this is a lookup for most entries
+        if event == 'sunrise':
+            next_time = self._sh.sun.rise(doff, moff)
+        else:
+            next_time = self._sh.sun.set(doff, moff)
+
+        now = self._sh.now()
+        if smin is not None:
+            dmin = next_time.replace(hour=smin[0], minute=smin[1], second=0, tzinfo=self._sh.tzinfo())
+            if dmin > next_time:
+                next_time = dmin
+        if smax is not None:
+            dmax = next_time.replace(hour=smax[0], minute=smax[1], second=0, tzinfo=self._sh.tzinfo())
+            if dmax < next_time:
+                if dmax < now:
+                    dmax = dmax + datetime.timedelta(days=1)
+                next_time = dmax
+        return next_time
+
+    def _parse_sun(self, crontab):
+        # returns (min, event, degree offset, minute offset, max) or None for a wrong syntax
         # find min/max times
         tabs = crontab.split('<')
         if len(tabs) == 1:
@@ -454,81 +1424,38 @@ class Scheduler(threading.Thread):
             cron = tabs[1].strip()
             smax = tabs[2].strip()
         else:
-            logger.error('Wrong syntax: {0}. Should be [H:M<](sunrise|sunset)[+|-][offset][<H:M]'.format(crontab))
-            return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
+            return None
 
         doff = 0  # degree offset
         moff = 0  # minute offset
-        tmp, op, offs = cron.rpartition('+')
-        if op:
-            if offs.endswith('m'):
-                moff = int(offs.strip('m'))
-            else:
-                doff = float(offs)
-        else:
-            tmp, op, offs = cron.rpartition('-')
+        try:
+            tmp, op, offs = cron.rpartition('+')
             if op:
                 if offs.endswith('m'):
-                    moff = -int(offs.strip('m'))
+                    moff = int(offs.strip('m'))
                 else:
-                    doff = -float(offs)
+                    doff = float(offs)
+            else:
+                tmp, op, offs = cron.rpartition('-')
+                if op:
+                    if offs.endswith('m'):
+                        moff = -int(offs.strip('m'))
+                    else:
+                        doff = -float(offs)
+            if smin is not None:
+                h, sep, m = smin.partition(':')
+                smin = (int(h), int(m))
+            if smax is not None:
+                h, sep, m = smax.partition(':')
+                smax = (int(h), int(m))
+        except ValueError:
+            return None
 
         if cron.startswith('sunrise'):
-            next_time = self._sh.sun.rise(doff, moff)
+            event = 'sunrise'
         elif cron.startswith('sunset'):
-            next_time = self._sh.sun.set(doff, moff)
+            event = 'sunset'
         else:
-            logger.error('Wrong syntax: {0}. Should be [H:M<](sunrise|sunset)[+|-][offset][<H:M]'.format(crontab))
-            return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
-
-        now = self._sh.now()
-        if smin is not None:
-            h, sep, m = smin.partition(':')
-            try:
-                dmin = next_time.replace(hour=int(h), minute=int(m), second=0, tzinfo=self._sh.tzinfo())
-            except Exception:
-                logger.error('Wrong syntax: {0}. Should be [H:M<](sunrise|sunset)[+|-][offset][<H:M]'.format(crontab))
-                return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
-            if dmin > next_time:
-                next_time = dmin
-        if smax is not None:
-            h, sep, m = smax.partition(':')
-            try:
-                dmax = next_time.replace(hour=int(h), minute=int(m), second=0, tzinfo=self._sh.tzinfo())
-            except Exception:
-                logger.error('Wrong syntax: {0}. Should be [H:M<](sunrise|sunset)[+|-][offset][<H:M]'.format(crontab))
-                return datetime.datetime.now(tzutc()) + dateutil.relativedelta.relativedelta(years=+10)
-            if dmax < next_time:
-                if dmax < now:
-                    dmax = dmax + datetime.timedelta(days=1)
-                next_time = dmax
-        return next_time
-
-    def _range(self, entry, low, high):
-        result = []
-        item_range = []
-        if entry == '*':
-            item_range = list(range(low, high + 1))
-        else:
-            for item in entry.split(','):
-                item = int(item)
-                if item > high:  # entry above range
-                    item = high  # truncate value to highest possible
-                item_range.append(item)
-        for entry in item_range:
-            result.append('{:02d}'.format(entry))
-        return result
+            return None
+        return smin, event, doff, moff, smax
 
-    def _day_range(self, days):
-        now = datetime.date.today()
-        wdays = [MO, TU, WE, TH, FR, SA, SU]
-        result = []
-        for day in days.split(','):
-            wday = wdays[int(day)]
-            # add next weekday occurence
-            day = now + dateutil.relativedelta.relativedelta(weekday=wday)
-            result.append(day.strftime("%d"))
-            # safety add-on if weekday equals todays weekday
-            day = now + dateutil.relativedelta.relativedelta(weekday=wday(+2))
-            result.append(day.strftime("%d"))
-        return result
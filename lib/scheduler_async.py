@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# async def needs Python 3.5 or newer: only imported with scheduler_backend = asyncio
+
+import asyncio
+import concurrent.futures
+import logging
+
+import lib.clock
+from lib.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Scheduler on an asyncio event loop (scheduler_backend = asyncio in smarthome.conf).
+
+    The loop sleeps on a timer handle for the earliest deadline instead of a polling thread.
+    Blocking tasks run on a thread pool of up to scheduler_workers_max threads, coroutine
+    functions (async def plugin methods) run on the loop itself and cost no thread.
+    Deadlines, the run queue, statistics and the add/change/trigger/remove API are shared
+    with Scheduler.
+    """
+
+    def __init__(self, smarthome):
+        Scheduler.__init__(self, smarthome)
+        self._loop = None
+        self._timer = None  # handle of the next _tick()
+        self._executor = None
+        self._busy = 0  # tasks running on the thread pool
+
+    def run(self):
+        self.alive = True
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._worker_max)
+        self._loop.call_soon(self._tick)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+
+    def stop(self):
+        self.alive = False
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._process_executor is not None:
+            self._process_executor.stop()
+
+    def _tick(self):
+        # like one pass of the main loop of Scheduler, but scheduling the next pass instead of waiting
+        if not self.alive:
+            return
+        with self._lock:
+            self._sync_clock()
+            now = self._clock.monotonic()
+            self._next_wakeup = None
+            self._check_clock(now)
+            trigger_next = self._trigger_due(now)
+            self._schedule_due(now)
+            wakeup = now + self._max_wait
+            if self._deadlines and self._deadlines[0][0] < wakeup:
+                wakeup = self._deadlines[0][0]
+            if trigger_next is not None and trigger_next < wakeup:
+                wakeup = trigger_next
+            self._next_wakeup = wakeup
+            self._timer = self._loop.call_at(self._loop.time() + max(0, wakeup - now), self._tick)
+        self._drain()
+
+    def _retick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._tick()
+
+    def _notify(self, deadline):
+        # the lock has to be held
+        if self._next_wakeup is not None and deadline < self._next_wakeup and self.alive:
+            self._next_wakeup = deadline
+            self._loop.call_soon_threadsafe(self._retick)
+
+    def _check_pool(self):
+        # called for new tasks in the run queue
+        if self._loop is not None and self.alive:
+            self._loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        # start the queued tasks as long as there are free threads, so the run queue keeps the order
+        while self._busy < self._worker_max:
+            try:
+                task = self._runq.get()
+            except IndexError:
+                return
+            if asyncio.iscoroutinefunction(task['obj']):
+                self._loop.create_task(self._execute_async(task))
+                continue
+            self._busy += 1
+            self._worker_peak = max(self._worker_peak, self._busy)
+            future = self._loop.run_in_executor(self._executor, self._execute, task)
+            future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._busy -= 1
+        self._drain()
+
+    async def _execute_async(self, task):
+        self._dequeue(task)
+        name = task['name']
+        self._release_pending(task)
+        start = self._clock.monotonic()
+        self._record_latency(task['prio'], start - task['enqueued'])
+        lateness = max(0.0, start - task['deadline'])
+        if lateness > self._late_threshold:
+            logger.warning("Scheduler: {0} started {1:.1f} seconds late".format(name, lateness))
+        with self._stats_lock:
+            self._running[name] = self._running.get(name, 0) + 1
+        run_start = lib.clock.monotonic()
+        ok = True
+        try:
+            if task['value'] is None:
+                await task['obj']()
+            else:
+                await task['obj'](**task['value'])
+        except Exception as e:
+            logging.getLogger(name).exception("Method {0} exception: {1}".format(name, e))
+            ok = False
+        self._record_run(name, start - task['enqueued'], lib.clock.monotonic() - run_start, ok, lateness)
+
+    def workers(self):
+        """
+        Returns the state of the thread pool: busy threads, high-water mark and maximum.
+        """
+        busy = self._busy
+        return {'size': busy, 'busy': busy, 'idle': 0, 'peak': self._worker_peak, 'min': 0, 'max': self._worker_max}
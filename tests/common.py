@@ -1,7 +1,51 @@
-
+import datetime
 import os
+import re
 import sys
 
 BASE = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, BASE)
 
+import lib.clock
+
+
+class MockSmartHome():
+    # the parts of bin/smarthome.SmartHome used by items, the cache, the scheduler and logics
+
+    _tzinfo = datetime.timezone.utc
+    sun = False
+    moon = False
+
+    def __init__(self):
+        self.items = {}
+        self.triggered = []  # keyword arguments of trigger()
+        self.clock = lib.clock.Clock()
+
+    def now(self):
+        return self.clock.now(self._tzinfo)
+
+    def tzinfo(self):
+        return self._tzinfo
+
+    def add_item(self, path, item):
+        self.items[path] = item
+
+    def return_item(self, path):
+        return self.items.get(path)
+
+    def return_plugins(self):
+        return []
+
+    def match_items(self, pattern):
+        regex = re.compile(pattern.replace('.', r'\.').replace('*', '.*') + '$')
+        return [item for path, item in self.items.items() if regex.match(path)]
+
+    def trigger(self, name, obj=None, value=None, **kwargs):
+        # recorded, an object (e.g. the eval of an item) is run at once
+        kwargs.update(name=name, obj=obj, value=value)
+        self.triggered.append(kwargs)
+        if obj is not None:
+            if value is None:
+                obj()
+            else:
+                obj(**value)
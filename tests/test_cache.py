@@ -0,0 +1,140 @@
+import common
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import lib.cache
+import lib.item
+from common import MockSmartHome
+
+
+class TestCacheWriter(unittest.TestCase):
+
+    backend = 'file'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp() + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writer(self, interval=3600, start=True):
+        sh = MockSmartHome()
+        sh._cache_dir = self.dir
+        sh._cache_interval = interval
+        sh._cache_backend = self.backend
+        writer = lib.cache.CacheWriter(sh)
+        if start:
+            writer.start()
+            self.addCleanup(writer.stop)
+        return writer
+
+    def read(self, path):
+        # the value as loaded by the next start
+        writer = self.writer(start=False)
+        try:
+            cached = writer.read(path)
+        finally:
+            writer.stop()
+        return cached[1] if cached else None
+
+    def test_coalesce(self):
+        writer = self.writer()
+        for value in range(10):
+            writer.write('meter', value)
+        writer.write('switch', True)
+        self.assertIsNone(self.read('meter'))
+        self.assertEqual(writer.stats()['pending'], 2)
+        self.assertEqual(writer.stats()['coalesced'], 9)
+        writer.flush()
+        self.assertEqual(self.read('meter'), 9)
+        self.assertEqual(self.read('switch'), True)
+        self.assertFalse([name for name in os.listdir(self.dir) if name.endswith('.tmp')])
+        stats = writer.stats()
+        self.assertEqual((stats['pending'], stats['written'], stats['flushes']), (0, 2, 1))
+
+    def test_stop(self):
+        writer = self.writer()
+        writer.write('meter', 42)
+        writer.stop()
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(self.read('meter'), 42)
+
+    def test_write_through(self):
+        writer = self.writer(interval=0)
+        writer.write('meter', 1)
+        self.assertEqual(writer.stats()['pending'], 0)
+        self.assertEqual(self.read('meter'), 1)
+
+    def test_load(self):
+        writer = self.writer()
+        writer.write('living.temp', 21.5)
+        writer.write('living.window', {'open': False})
+        writer.stop()
+        writer = self.writer(start=False)
+        self.addCleanup(writer.stop)
+        changed, value = writer.read('living.temp')
+        self.assertEqual(value, 21.5)
+        self.assertEqual(changed.tzinfo, datetime.timezone.utc)
+        self.assertLess(abs((datetime.datetime.now(datetime.timezone.utc) - changed).total_seconds()), 60)
+        self.assertEqual(writer.read('living.window')[1], {'open': False})
+        self.assertIsNone(writer.read('living.door'))
+
+    def test_items(self):
+        writer = self.writer()
+        sh = MockSmartHome()
+        sh.cache = writer
+        meter = lib.item.Item(sh, sh, 'meter', {'type': 'num', 'cache': 'yes', 'value': 3})
+        self.assertEqual(writer.stats()['pending'], 1)  # created with the initial value
+        meter(4)
+        meter(5)
+        writer.stop()
+        self.assertEqual(self.read('meter'), 5)
+        sh.cache = self.writer(start=False)
+        meter = lib.item.Item(sh, sh, 'meter', {'type': 'num', 'cache': 'yes', 'value': 3})
+        self.assertEqual(meter(), 5)
+        self.assertEqual(meter.changed_by(), 'Cache:None')
+        self.assertEqual(sh.cache.stats()['pending'], 0)
+        sh.cache.stop()
+
+    def test_last_change(self):
+        # the time of the last change of the item, not of the write
+        writer = self.writer()
+        sh = MockSmartHome()
+        sh.cache = writer
+        changed = datetime.datetime(2016, 5, 1, 12, 30, 15, tzinfo=datetime.timezone.utc)
+        sh.now = lambda: changed
+        meter = lib.item.Item(sh, sh, 'meter', {'type': 'num', 'cache': 'yes'})
+        meter(4)
+        writer.stop()
+        sh.now = MockSmartHome().now
+        sh.cache = self.writer(start=False)
+        self.addCleanup(sh.cache.stop)
+        meter = lib.item.Item(sh, sh, 'meter', {'type': 'num', 'cache': 'yes'})
+        self.assertEqual((meter.last_change(), meter()), (changed, 4))
+
+
+class TestSQLiteCache(TestCacheWriter):
+
+    backend = 'sqlite'
+
+    def test_migrate(self):
+        for path, value in (('meter', 1), ('switch', True)):
+            with open(self.dir + path, 'wb') as f:
+                pickle.dump(value, f)
+        os.utime(self.dir + 'meter', (1000, 1000))
+        writer = self.writer(start=False)
+        changed, value = writer.read('meter')
+        self.assertEqual(value, 1)
+        self.assertEqual(changed, datetime.datetime.fromtimestamp(1000, datetime.timezone.utc))
+        self.assertEqual(writer.read('switch')[1], True)
+        writer.stop()
+        self.assertEqual([name for name in os.listdir(self.dir) if not name.startswith('.')], [])
+        self.assertEqual(self.read('meter'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,144 @@
+import common
+import logging
+import unittest
+
+import lib.item
+from common import MockSmartHome
+
+
+class TestItem(unittest.TestCase):
+
+    def tree(self, config):
+        sh = MockSmartHome()
+        top = {}
+        for path, value in config.items():
+            top[path] = lib.item.Item(sh, sh, path, value)
+            sh.items[path] = top[path]
+            vars(sh)[path] = top[path]
+        return sh, top
+
+    def test_children(self):
+        sh, top = self.tree({'living': {'light': {'type': 'bool', 'dimmer': {'type': 'num', 'value': 42}}, 'id': {'type': 'str'}}})
+        living = top['living']
+        self.assertIs(living.light, sh.items['living.light'])
+        self.assertEqual(living.light.dimmer(), 42)
+        self.assertIs(living['light'], living.light)
+        self.assertEqual([child.id() for child in living], ['living.light', 'living.id'])
+        self.assertEqual(list(living.light.dimmer.return_children()), [])
+        # a child named like a method shadows the method
+        self.assertIs(living.id, sh.items['living.id'])
+        with self.assertRaises(AttributeError):
+            living.kitchen
+        with self.assertRaises(KeyError):
+            living['kitchen']
+
+    def test_attributes(self):
+        sh, top = self.tree({'meter': {'type': 'num', 'visu': 'yes', 'threshold': '10:20'}})
+        meter = top['meter']
+        self.assertEqual(meter.conf, {'visu': 'yes'})
+        self.assertFalse(hasattr(meter, '__dict__') and vars(meter))
+        meter['plugin_attr'] = 1  # plugins may still add attributes
+        self.assertEqual(meter.plugin_attr, 1)
+        self.assertEqual(meter['plugin_attr'], 1)
+        self.assertEqual(meter['conf'], {'visu': 'yes'})
+
+    def test_update(self):
+        sh, top = self.tree({'meter': {'type': 'num', 'threshold': '10:20'}})
+        meter = top['meter']
+        logics = []
+        meter.add_logic_trigger(Logic(logics))
+        methods = []
+        meter.add_method_trigger(lambda item, caller, source, dest: methods.append(item()))
+        for value in (5, 15, 25, 15, 5, 25):
+            meter(value)
+        self.assertEqual(methods, [5, 15, 25, 15, 5, 25])
+        self.assertEqual(logics, [25, 5, 25])  # only crossings
+        self.assertEqual(meter.prev_value(), 5)
+        self.assertEqual(meter.changed_by(), 'Logic:None')
+
+    def test_eval(self):
+        sh, top = self.tree({'temp': {'a': {'type': 'num', 'value': 20}, 'b': {'type': 'num', 'value': 22},
+                                      'avg': {'type': 'num', 'eval': 'avg', 'eval_trigger': ['temp.a', 'temp.b']},
+                                      'double': {'type': 'num', 'eval': 'value * 2'},
+                                      'broken': {'type': 'num', 'eval': 'sh.temp.a( +', 'eval_trigger': 'temp.a'}}})
+        logs = LogRecorder(logging.ERROR)
+        logging.getLogger('lib.item').addHandler(logs)
+        try:
+            for item in sh.items.values():
+                item._init_prerun()
+        finally:
+            logging.getLogger('lib.item').removeHandler(logs)
+        self.assertIn('temp.broken', logs.messages[0])  # reported at startup
+        avg = sh.items['temp.avg']
+        self.assertEqual(avg._eval, '(sh.temp.a() + sh.temp.b())/2')
+        self.assertIsNotNone(avg._eval_code)
+        sh.items['temp.a'](24)
+        self.assertEqual(avg(), 23)
+        sh.items['temp.double'](4)
+        self.assertEqual(sh.items['temp.double'](), 8)
+        self.assertEqual(sh.items['temp.broken'](), 0)
+
+    def test_aggregate(self):
+        sources = {'s{}'.format(index): {'type': 'num', 'value': index} for index in range(1, 6)}
+        windows = {'w{}'.format(index): {'type': 'bool'} for index in range(3)}
+        config = {'sensors': sources, 'windows': windows, 'mixed': {'type': 'str', 'value': 'x'}}
+        for kind in ('sum', 'avg', 'min', 'max'):
+            config['sensors'][kind] = {'type': 'num', 'eval': kind, 'eval_trigger': 'sensors.s*'}
+        for kind in ('and', 'or'):
+            config['windows'][kind] = {'type': 'bool', 'eval': kind, 'eval_trigger': 'windows.w*'}
+        config['mixed']['sum'] = {'type': 'str', 'eval': 'sum', 'eval_trigger': 'mixed'}
+        sh, top = self.tree(config)
+        sh.match_items = lambda pattern: [item for path, item in sh.items.items() if path[:-1] == pattern[:-1]] if pattern.endswith('*') else [sh.items[pattern]]
+        for item in sh.items.values():
+            item._init_prerun()
+        for item in sh.items.values():
+            item._init_run()
+        self.assertIsNone(sh.items['mixed.sum']._aggregate)  # not a num source: evaluated as expression
+
+        def check():
+            values = [sh.items['sensors.s{}'.format(index)]() for index in range(1, 6)]
+            for kind, expected in (('sum', sum(values)), ('avg', sum(values) / 5), ('min', min(values)), ('max', max(values))):
+                item = sh.items['sensors.' + kind]
+                self.assertIsNotNone(item._aggregate)
+                self.assertEqual(item(), expected, kind)
+            windows = [sh.items['windows.w{}'.format(index)]() for index in range(3)]
+            for kind, expected in (('and', all(windows)), ('or', any(windows))):
+                item = sh.items['windows.' + kind]
+                self.assertEqual(item(), expected, kind)
+
+        check()
+        for path, value in (('sensors.s3', 10), ('sensors.s5', -2), ('sensors.s3', 1), ('sensors.s1', 1.5), ('windows.w1', True),
+                            ('sensors.s5', 5), ('sensors.s2', 7), ('windows.w0', True), ('windows.w2', True), ('windows.w1', False)):
+            sh.items[path](value)
+            check()
+        sh.items['sensors.s2'].set(0)  # set() updates the aggregates without triggering
+        sh.items['sensors.s1'](2)
+        check()
+        for value in range(100):  # the lazily removed values do not pile up
+            sh.items['sensors.s4'](value)
+        self.assertLessEqual(len(sh.items['sensors.min']._aggregate._heap), 10)
+        check()
+
+
+class Logic():
+
+    def __init__(self, triggered):
+        self.triggered = triggered
+
+    def trigger(self, by, source, value):
+        self.triggered.append(value)
+
+
+class LogRecorder(logging.Handler):
+    # TestCase.assertLogs() needs Python 3.4
+
+    def __init__(self, level):
+        logging.Handler.__init__(self, level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,72 @@
+import common
+import datetime
+import unittest
+
+import lib.clock
+import lib.orb
+from dateutil.tz import tzutc
+
+
+@unittest.skipIf(lib.orb.ephem is None, "ephem is not installed")
+class TestOrb(unittest.TestCase):
+
+    lon, lat = 10.4476, 51.1633
+
+    def uncached(self, kind, origin, doff=0, center=True):
+        obs = lib.orb.ephem.Observer()
+        obs.long = str(self.lon)
+        obs.lat = str(self.lat)
+        obs.date = origin.replace(tzinfo=None)
+        obs.horizon = str(doff)
+        method = obs.next_rising if kind == 'rise' else obs.next_setting
+        if doff == 0:
+            event = method(lib.orb.ephem.Sun())
+        else:
+            event = method(lib.orb.ephem.Sun(), use_center=center)
+        return event.datetime().replace(tzinfo=tzutc())
+
+    def assertClose(self, first, second):
+        self.assertLess(abs((first - second).total_seconds()), 1, (first, second))
+
+    def test_rise_set(self):
+        sun = lib.orb.Orb('sun', self.lon, self.lat)
+        midnight = datetime.datetime(2016, 3, 20, tzinfo=tzutc())
+        # around midnight, before and after sunrise (about 05:20 utc) and sunset (about 17:35 utc), over three days
+        for hours in (-0.5, 0, 0.5, 4, 5.5, 6, 12, 17.5, 18, 23.9, 24.1, 30, 47.9, 48.1, 60):
+            origin = midnight + datetime.timedelta(hours=hours)
+            for doff in (0, -6):
+                self.assertClose(sun.rise(doff, dt=origin), self.uncached('rise', origin, doff))
+                self.assertClose(sun.set(doff, dt=origin), self.uncached('set', origin, doff))
+
+    def test_precompute(self):
+        start = datetime.datetime(2016, 3, 20, 12, tzinfo=tzutc())
+        clock = lib.clock.VirtualClock(start)
+        sun = lib.orb.Orb('sun', self.lon, self.lat, clock=clock)
+        sun.rise()
+        sun.set(-6)
+        clock.advance(12 * 3600)  # midnight
+        sun.precompute()
+        computed = dict(sun._events)
+        clock.advance(8 * 3600)  # after today's sunrise
+        rise, dusk = sun.rise(), sun.set(-6)
+        self.assertEqual(sun._events, computed)  # served from the precomputed entries
+        self.assertClose(rise, self.uncached('rise', clock.now(tzutc())))
+        self.assertClose(dusk, self.uncached('set', clock.now(tzutc()), -6))
+
+
+    def test_precompute_east(self):
+        # local midnight of utc+2 is 22:00 utc, the next utc day is precomputed as well
+        start = datetime.datetime(2016, 3, 20, 12, tzinfo=tzutc())
+        clock = lib.clock.VirtualClock(start)
+        sun = lib.orb.Orb('sun', self.lon, self.lat, clock=clock)
+        sun.rise()
+        clock.advance(10 * 3600)
+        sun.precompute()
+        computed = dict(sun._events)
+        clock.advance(8 * 3600)  # 06:00 utc of the next day, after sunrise
+        rise = sun.rise()
+        self.assertEqual(sun._events, computed)
+        self.assertClose(rise, self.uncached('rise', clock.now(tzutc())))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+import common
+import calendar
+import collections
+import datetime
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+from dateutil.tz import tzutc
+
+import lib.clock
+import lib.logic
+import lib.orb
+import lib.scheduler
+from common import MockSmartHome
+
+
+class TestPriorityQueue(unittest.TestCase):
+
+    def test_order(self):
+        queue = lib.scheduler.PriorityQueue()
+        queue.insert(3, 'a')
+        queue.insert(1, 'b')
+        queue.insert_many([(3, 'c'), (1, 'd'), (2, 'e')])
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual(queue.peek(), (1, 'b'))
+        self.assertEqual([queue.get()[1] for i in range(5)], ['b', 'd', 'e', 'a', 'c'])
+        self.assertRaises(IndexError, queue.get)
+        self.assertRaises(IndexError, queue.get, True, 0.01)
+
+    def test_blocking_get(self):
+        queue = lib.scheduler.PriorityQueue()
+        timer = threading.Timer(0.05, queue.insert, (1, 'a'))
+        timer.start()
+        self.assertEqual(queue.get(block=True, timeout=2), (1, 'a'))
+
+
+class TestCrontab(unittest.TestCase):
+
+    def _brute_force(self, minutes, hours, days, wdays, now):
+        dt = now.replace(second=0, microsecond=0)
+        for i in range(70 * 24 * 60):
+            dt += datetime.timedelta(minutes=1)
+            mdays = calendar.monthrange(dt.year, dt.month)[1]
+            day_match = dt.weekday() in wdays or dt.day in days or (dt.day == mdays and max(days or [0]) > mdays)
+            if dt.minute in minutes and dt.hour in hours and day_match:
+                return dt
+
+    def test_next(self):
+        tz = tzutc()
+        starts = [datetime.datetime(2016, 2, 28, 23, 59, 30, tzinfo=tz), datetime.datetime(2016, 12, 31, 12, 0, tzinfo=tz), datetime.datetime(2017, 4, 29, 6, 15, tzinfo=tz),
+                  datetime.datetime(2017, 4, 29, 3, 35, tzinfo=tz), datetime.datetime(2017, 4, 30, 8, 20, tzinfo=tz)]  # before a later matching hour
+        crontabs = [
+            ('* * * *', range(60), range(24), range(1, 32), []),
+            ('0 6 * *', [0], [6], range(1, 32), []),
+            ('15,45 8,20 * 0,6', [15, 45], [8, 20], [], [0, 6]),
+            ('30 12 31 *', [30], [12], [31], []),
+            ('0 0 1,15 2', [0], [0], [1, 15], [2]),
+            ('59 23 30 *', [59], [23], [30], []),
+        ]
+        for expression, minutes, hours, days, wdays in crontabs:
+            crontab = lib.scheduler.Crontab.get(expression)
+            for now in starts:
+                self.assertEqual(crontab.next(now), self._brute_force(minutes, hours, days, wdays, now), "{} {}".format(expression, now))
+
+    def test_random(self):
+        rnd = random.Random(5)
+        tz = tzutc()
+
+        def sample(low, high):
+            return sorted(rnd.sample(range(low, high + 1), rnd.randint(1, 3)))
+        for i in range(100):
+            minutes, hours = sample(0, 59), sample(0, 23)
+            days = sample(1, 31) if rnd.random() < 0.5 else []
+            wdays = sample(0, 6) if not days or rnd.random() < 0.3 else []
+            expression = ' '.join(','.join(str(value) for value in field) or '*' for field in (minutes, hours, days, wdays))
+            if not days and not wdays:
+                days = range(1, 32)
+            now = datetime.datetime(2016, 1, 1, tzinfo=tz) + datetime.timedelta(minutes=rnd.randint(0, 366 * 24 * 60))
+            crontab = lib.scheduler.Crontab.get(expression)
+            self.assertEqual(crontab.next(now), self._brute_force(minutes, hours, days, wdays, now), "{} {}".format(expression, now))
+
+    def test_cached(self):
+        self.assertIs(lib.scheduler.Crontab.get('1 2 * *'), lib.scheduler.Crontab.get('1 2 * *'))
+        self.assertRaises(ValueError, lib.scheduler.Crontab, '1 2 *')
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.sh = MockSmartHome()
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+
+    def _run_queued(self):
+        while self.scheduler._runq.qsize():
+            task = self.scheduler._runq.get()
+            self.scheduler._execute(task)
+
+    def _queued(self):
+        names = []
+        while self.scheduler._runq.qsize():
+            task = self.scheduler._runq.get()
+            names.append(task['name'])
+        return names
+
+    def test_only_due_jobs_fire(self):
+        now = self.sh.now()
+        self.scheduler.add('due', self._dummy, next=now - datetime.timedelta(seconds=1))
+        self.scheduler.add('later', self._dummy, next=now + datetime.timedelta(hours=1))
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self._queued(), ['due'])
+        self.assertIsNone(self.scheduler.return_next('due'))
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self._queued(), [])
+
+    def test_remove_and_change_invalidate(self):
+        now = self.sh.now()
+        past = now - datetime.timedelta(seconds=1)
+        self.scheduler.add('removed', self._dummy, next=past)
+        self.scheduler.add('changed', self._dummy, next=past)
+        self.scheduler.remove('removed')
+        self.scheduler.change('changed', next=now + datetime.timedelta(hours=1))
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self._queued(), [])
+        self.scheduler.change('changed', active=False)
+        self.scheduler._schedule_due(self.scheduler._monotonic(now + datetime.timedelta(hours=2)))
+        self.assertEqual(self._queued(), [])
+
+    def test_cycle_rescheduled(self):
+        self.scheduler.add('cycle', self._dummy, cycle=60, offset=0)
+        now = self.sh.now() + datetime.timedelta(seconds=1)
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self._queued(), ['cycle'])
+        self.assertGreater(self.scheduler.return_next('cycle'), now)
+
+    def _job_deadlines(self):
+        return dict((name, deadline) for deadline, seq, name in self.scheduler._deadlines if self.scheduler._scheduler[name]['seq'] == seq)
+
+    def test_add_many(self):
+        jobs = [{'name': 'item{}'.format(i), 'obj': self._dummy, 'cron': ['0 6 * *', '0 18 * *']} for i in range(100)]
+        jobs.append({'name': 'init', 'obj': self._dummy, 'cron': 'init+1 = 42'})
+        with self.scheduler.deferred():
+            self.scheduler.add_many(jobs)
+            self.scheduler.add('cycle', self._dummy, cycle=60)
+            self.assertIsNone(self.scheduler.return_next('item0'))
+            self.assertIsNotNone(self.scheduler.return_next('init'))
+        self.assertEqual(len(self.scheduler._cron_entries), 2)
+        self.assertEqual(len(set(self.scheduler.return_next('item{}'.format(i)) for i in range(100))), 1)
+        self.assertEqual(self.scheduler.return_next('item0').minute, 0)
+        self.assertEqual(self.scheduler.get('init')['value'], '42')
+        self.assertIsNotNone(self.scheduler.return_next('cycle'))
+        self.assertIsNone(self.scheduler._deferred)
+
+    def test_deferred_chunks(self):
+        # the first fire times are calculated in chunks, the lock is released in between
+        self.scheduler._deferred_chunk = 30
+        with self.scheduler.deferred():
+            for i in range(100):
+                self.scheduler.add('item{}'.format(i), self._dummy, cron='0 6 * *')
+            lock = self.scheduler._lock = CountingLock(self.scheduler._lock)
+        self.assertEqual(lock.count, 5)  # taking the jobs + 4 chunks
+        self.assertTrue(all(self.scheduler.return_next('item{}'.format(i)) for i in range(100)))
+
+    def test_phase_allocation(self):
+        for i in range(4):
+            self.scheduler.add('poll{}'.format(i), self._dummy, cycle=60)
+        self.scheduler.add('heavy', self._dummy, cycle=60, weight=4)
+        profile = dict(self.scheduler.load_profile())
+        self.assertEqual(len(profile), 60)
+        self.assertEqual([second for second, load in profile.items() if load], [0, 7, 15, 30, 45])
+        self.assertEqual(profile[7], 4)
+        phases = set(round(lib.clock.timestamp(self.scheduler.return_next('poll{}'.format(i)))) % 60 for i in range(4))
+        self.assertEqual(phases, set([0, 15, 30, 45]))
+        offset = (self.scheduler.return_next('poll0') - self.sh.now()).total_seconds()
+        self.assertTrue(9 <= offset <= 70, offset)
+        self.scheduler.remove('heavy')
+        self.assertEqual(sum(load for second, load in self.scheduler.load_profile()), 4)
+        self.scheduler.change('poll0', cycle={300: None})
+        self.assertEqual(sum(load for second, load in self.scheduler.load_profile()), 3.2)
+        # a job every 15 seconds uses four slots
+        self.scheduler.add('fast', self._dummy, cycle=15)
+        self.assertEqual(sum(load for second, load in self.scheduler.load_profile()), 7.2)
+
+    def test_phase_periods(self):
+        # all periods share one table: the jobs do not bunch at the start of the minute
+        for period in (60, 120, 180, 300, 600):
+            for i in range(20):
+                self.scheduler.add('job{}_{}'.format(period, i), self._dummy, cycle=period)
+        seconds = collections.Counter(job['phase'][1] for job in self.scheduler._scheduler.values())
+        self.assertEqual(max(seconds.values()), 2)
+        # the first run is within a minute after the minimal delay, whatever the period
+        self.scheduler.add('daily', self._dummy, cycle=86400)
+        offset = (self.scheduler.return_next('daily') - self.sh.now()).total_seconds()
+        self.assertTrue(9 <= offset <= 70, offset)
+
+    def test_fixed_rate(self):
+        self.scheduler.add('pwm', self._dummy, cycle='0.25', offset=0.25, fixed_rate=True)
+        self.assertEqual(self.scheduler.get('pwm')['cycle'], {0.25: None})
+        deadline = self._job_deadlines()['pwm']
+        self.scheduler._schedule_due(deadline + 0.01)
+        self.assertEqual(self._queued(), ['pwm'])
+        self.assertEqual(self._job_deadlines()['pwm'], deadline + 0.25)
+        self.scheduler._running['pwm'] = 1  # still running: the run is skipped, the rate is kept
+        self.scheduler._schedule_due(deadline + 0.26)
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(self._job_deadlines()['pwm'], deadline + 0.5)
+        del(self.scheduler._running['pwm'])
+        self.scheduler._schedule_due(deadline + 1.1)  # 0.5 and 0.75 are missed
+        self.assertEqual(self._queued(), ['pwm'])
+        self.assertEqual(self._job_deadlines()['pwm'], deadline + 1.25)
+        self.assertEqual(self.scheduler.stats('pwm')['skipped'], 3)
+        self.assertGreater(self.scheduler.return_next('pwm'), self.sh.now())
+
+    def test_fractional_cycle(self):
+        self.scheduler.add('fast', self._dummy, cycle=0.5, offset=0.5)
+        self.scheduler._schedule_due(self._job_deadlines()['fast'] + 0.01)
+        self.assertEqual(self._queued(), ['fast'])
+        self.assertLess(self._job_deadlines()['fast'] - lib.clock.monotonic(), 0.51)
+        self.assertGreater(self._job_deadlines()['fast'] - lib.clock.monotonic(), 0.4)
+
+    def test_item_groups(self):
+        self.scheduler._group_size = 3
+        items = dict(('item{}'.format(i), MockItem(None)) for i in range(5))
+        for name, item in items.items():
+            self.scheduler.add_item(name, item, cycle='60 = 1')
+        self.scheduler.add_item('other', MockItem(None), cron=['0 6 * * = 2'])
+        self.scheduler.add_item('init', MockItem(None), cron=['init = 3'])
+        groups = self.scheduler.groups()
+        self.assertEqual(sorted(group['items'] for group in groups.values()), [1, 2, 3])
+        self.assertIn('init', self.scheduler._scheduler)
+        self.assertEqual(self.scheduler.get('item0')['obj'].name, 'Items 1')
+        self.assertEqual(self.scheduler.return_next('item4'), self.scheduler.return_next('Items 2'))
+        self.assertEqual(sum(load for second, load in self.scheduler.load_profile()), 5)
+        self.scheduler._schedule_due(lib.clock.monotonic() + 71)  # first run within 10 - 70 seconds
+        self._run_queued()
+        self.assertEqual([item.values for item in items.values()], [['1']] * 5)
+        self.assertEqual(self.scheduler.stats('Items 1')['runs'], 1)
+        self.scheduler.remove('item3')
+        self.scheduler.remove('item4')
+        self.assertNotIn('Items 2', self.scheduler.groups())
+        self.scheduler.change('item0', cycle={120: None})
+        self.assertEqual(self.scheduler.groups()['Items 1']['items'], 2)
+        self.assertEqual(self.scheduler.get('item0')['obj'], items['item0'])
+        self.assertEqual(sum(load for second, load in self.scheduler.load_profile()), 2.5)  # item0 runs every 120 seconds
+
+    def test_simulate(self):
+        self.sh.clock = lib.clock.VirtualClock(datetime.datetime(2016, 3, 1, tzinfo=tzutc()))
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+        self.assertRaises(ValueError, lib.scheduler.Scheduler(MockSmartHome()).simulate, 60)
+        runs = []
+
+        def hourly():
+            runs.append(self.sh.now())
+            self.scheduler.trigger('delayed', self._dummy, dt=self.sh.now() + datetime.timedelta(minutes=30))
+        self.scheduler.add('hourly', hourly, cron='0 * * *')
+        self.scheduler.add('cycle', self._dummy, cycle=600)
+        self.scheduler.add('fast', self._dummy, cycle=2.5, offset=2.5, fixed_rate=True)
+        start = time.time()
+        log = self.scheduler.simulate(24 * 3600)
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(self.sh.now(), datetime.datetime(2016, 3, 2, tzinfo=tzutc()))
+        names = [name for dt, name in log]
+        self.assertEqual(names.count('hourly'), 24)
+        self.assertEqual(names.count('delayed'), 23)  # the last one is due after the simulated day
+        self.assertEqual(names.count('cycle'), 144)
+        self.assertEqual(names.count('fast'), 24 * 3600 / 2.5)
+        self.assertEqual(runs[0], datetime.datetime(2016, 3, 1, 1, tzinfo=tzutc()))
+        self.assertEqual(self.scheduler.stats('hourly')['late'], 0)
+        self.assertIn((datetime.datetime(2016, 3, 1, 1, 30, tzinfo=tzutc()), 'delayed'), log)
+        self.assertEqual(self.scheduler.simulate(3600, execute=False).count((datetime.datetime(2016, 3, 2, 1, tzinfo=tzutc()), 'hourly')), 1)
+
+    def test_simulate_cron_list(self):
+        self.sh.clock = lib.clock.VirtualClock(datetime.datetime(2016, 3, 1, 3, 35, tzinfo=tzutc()))
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+        self.scheduler.add('twice', self._dummy, cron=['0 6 * *', '0 18 * *'])
+        runs = [dt for dt, name in self.scheduler.simulate(3 * 86400)]
+        self.assertEqual(len(runs), 6)
+        self.assertEqual(runs[:2], [datetime.datetime(2016, 3, 1, 6, tzinfo=tzutc()), datetime.datetime(2016, 3, 1, 18, tzinfo=tzutc())])
+
+    @unittest.skipIf(lib.orb.ephem is None, "ephem is not installed")
+    def test_simulate_sun(self):
+        # the orbs follow sh.clock when it is replaced
+        self.sh.sun = lib.orb.Orb('sun', 10.4476, 51.1633, clock=self.sh.clock)
+        self.scheduler.add('sunrise', self._dummy, cron='sunrise')
+        self.sh.clock = lib.clock.VirtualClock(datetime.datetime(2016, 3, 20, tzinfo=tzutc()))
+        runs = [dt for dt, name in self.scheduler.simulate(2 * 86400)]
+        self.assertEqual([dt.day for dt in runs], [20, 21])
+        self.assertEqual([dt.hour for dt in runs], [5, 5])  # about 05:20 utc
+
+    def test_simulate_clock_set_later(self):
+        # the virtual clock is set after the scheduler and its jobs were created
+        self.scheduler.add('hourly', self._dummy, cron='0 * * *')
+        self.scheduler.add('cycle', self._dummy, cycle=600, offset=600)
+        self.scheduler.trigger('delayed', self._dummy, dt=self.sh.now() + datetime.timedelta(seconds=90))
+        self.sh.clock = lib.clock.VirtualClock(datetime.datetime(2016, 3, 1, tzinfo=tzutc()))
+        log = self.scheduler.simulate(3600)
+        start = datetime.datetime(2016, 3, 1, tzinfo=tzutc())
+        self.assertEqual(log[0][1], 'delayed')
+        self.assertAlmostEqual((log[0][0] - start).total_seconds(), 90, delta=1)
+        self.assertIn((datetime.datetime(2016, 3, 1, 1, tzinfo=tzutc()), 'hourly'), log)
+        self.assertEqual([name for dt, name in log].count('cycle'), 6)
+        self.assertAlmostEqual((self.scheduler.return_next('cycle') - start).total_seconds(), 4200, delta=1)
+
+    def test_clock_step(self):
+        self.scheduler.add('cron', self._dummy, cron='* * * *')
+        self.scheduler.add('cycle', self._dummy, cycle=600, offset=600)
+        cycle_next = self.scheduler.return_next('cycle')
+        cycle_deadline = self._job_deadlines()['cycle']
+        self.scheduler._clock_offset -= 3600  # the wall clock was set one hour ahead
+        self.scheduler._check_clock(lib.clock.monotonic())
+        self.assertEqual(self.scheduler.return_next('cycle'), cycle_next + datetime.timedelta(hours=1))
+        deadlines = self._job_deadlines()
+        self.assertEqual(deadlines['cycle'], cycle_deadline)
+        self.assertLess(deadlines['cron'], lib.clock.monotonic() + 61)
+        self.scheduler._schedule_due(lib.clock.monotonic() + 61)
+        self.assertEqual(self._queued(), ['cron'])
+
+    def test_clock_read_after_lock(self):
+        # time spent before the main loop holds the lock is no step of the wall clock
+        self.scheduler._clock_step = 0.2
+        self.scheduler._check_pool = lambda: time.sleep(0.3)
+        offset = self.scheduler._clock_offset
+        self.scheduler.start()
+        try:
+            time.sleep(0.5)
+        finally:
+            self.scheduler.stop()
+            self.scheduler.join(2)
+        self.assertLess(abs(self.scheduler._clock_offset - offset), 0.1)
+
+    def test_trigger_wakes_up_loop(self):
+        fired = threading.Event()
+        self.scheduler.start()
+        try:
+            time.sleep(0.1)  # main loop is sleeping now
+            start = time.time()
+            self.scheduler.trigger('wakeup', fired.set, dt=self.sh.now() + datetime.timedelta(seconds=0.2))
+            self.assertTrue(fired.wait(2))
+            self.assertLess(time.time() - start, 0.5)
+            time.sleep(0.05)
+            self.assertEqual(self.scheduler.latency()[3]['count'], 1)
+        finally:
+            self.scheduler.stop()
+            self.scheduler.join(2)
+
+    def test_stats(self):
+        self.scheduler.trigger('ok', self._dummy)
+        self.scheduler.trigger('fails', self._fail)
+        self.scheduler.trigger('fails', self._fail)
+        self._run_queued()
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['ok']['runs'], 1)
+        self.assertEqual(stats['ok']['exceptions'], 0)
+        self.assertEqual(stats['fails']['runs'], 2)
+        self.assertEqual(stats['fails']['exceptions'], 2)
+        self.assertEqual(sum(count for bound, count in stats['fails']['time']), 2)
+        self.assertEqual(self.scheduler.stats('ok')['running'], 0)
+
+    def test_coalesce(self):
+        values = []
+
+        def append(value):
+            values.append(value)
+        for value in range(3):
+            self.scheduler.trigger('eval', append, value={'value': value}, coalesce=True)
+        self.scheduler.trigger('eval', append, value={'value': 'other'})
+        self._run_queued()
+        self.assertEqual(values, [2, 'other'])
+        self.assertEqual(self.scheduler.stats('eval')['coalesced'], 2)
+        self.scheduler.trigger('eval', append, value={'value': 3}, coalesce=True)
+        self._run_queued()
+        self.assertEqual(values, [2, 'other', 3])
+
+    def test_deadline_order(self):
+        now = self.sh.now()
+        self.scheduler.add('old_low', self._dummy, prio=5, next=now - datetime.timedelta(seconds=10))
+        self.scheduler.add('new_low', self._dummy, prio=5, next=now - datetime.timedelta(seconds=1))
+        self.scheduler.add('new_high', self._dummy, prio=1, next=now - datetime.timedelta(seconds=1))
+        self.scheduler.add('old_normal', self._dummy, prio=3, next=now - datetime.timedelta(seconds=20))
+        self.scheduler.add('starving', self._dummy, prio=8, next=now - datetime.timedelta(seconds=200))  # aged to prio 2
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self._queued(), ['new_high', 'starving', 'old_normal', 'old_low', 'new_low'])
+
+    def test_no_aging(self):
+        self.sh._scheduler_prio_aging = '0'
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+        now = self.sh.now()
+        self.scheduler.add('starving', self._dummy, prio=8, next=now - datetime.timedelta(seconds=200))
+        self.scheduler.add('normal', self._dummy, prio=5, next=now - datetime.timedelta(seconds=1))
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self._queued(), ['normal', 'starving'])
+
+    def test_lateness(self):
+        self.scheduler._late_threshold = 1
+        now = self.sh.now()
+        self.scheduler.add('late', self._dummy, next=now - datetime.timedelta(seconds=2))
+        self.scheduler.add('in_time', self._dummy, next=now)
+        self.scheduler._schedule_due(self.scheduler._monotonic(now + datetime.timedelta(microseconds=1)))
+        self._run_queued()
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['late']['late'], 1)
+        self.assertGreaterEqual(stats['late']['lateness_max'], 2)
+        self.assertEqual(stats['late']['lateness'][-3], (10, 1))
+        self.assertEqual(stats['in_time']['late'], 0)
+
+    def _serial_run(self, concurrency):
+        # runs 'first' in a thread, triggers while it is running and returns the values in the order of execution
+        release = threading.Event()
+        values = []
+
+        def task(value):
+            values.append(value)
+            if value == 'first':
+                release.wait(5)
+        task.concurrency = concurrency
+        self.scheduler.trigger('serial', task, value={'value': 'first'})
+        first = threading.Thread(target=self.scheduler._execute, args=(self.scheduler._runq.get(), ))
+        first.start()
+        time.sleep(0.05)
+        for value in ('second', 'third'):
+            self.scheduler.trigger('serial', task, value={'value': value})
+        self.scheduler.trigger('other', task, value={'value': 'other'})
+        self._run_queued()  # returns without waiting for 'first'
+        self.assertTrue(first.is_alive())
+        release.set()
+        first.join(5)
+        return values
+
+    def test_serial_queue(self):
+        self.assertEqual(self._serial_run('queue'), ['first', 'other', 'second', 'third'])
+        self.assertEqual(self.scheduler._serial, {})
+
+    def test_serial_scheduled(self):
+        # runs of an overrunning cron/cycle job do not pile up, only the latest one waits
+        release = threading.Event()
+        values = []
+
+        def task(value):
+            values.append(value)
+            if value == 'first':
+                release.wait(5)
+        self.scheduler._enqueue([(5, ('job', task, 'Scheduler', None, None, {'value': 'first'}), None)])
+        first = threading.Thread(target=self.scheduler._execute, args=(self.scheduler._runq.get(), ))
+        first.start()
+        time.sleep(0.05)
+        for value in ('second', 'third'):
+            self.scheduler._enqueue([(5, ('job', task, 'Scheduler', None, None, {'value': value}), None)])
+        self.scheduler.trigger('job', task, value={'value': 'triggered'})
+        self.scheduler._enqueue([(5, ('job', task, 'Scheduler', None, None, {'value': 'fourth'}), None)])
+        self._run_queued()
+        self.assertEqual(len(self.scheduler._serial['job']), 2)
+        release.set()
+        first.join(5)
+        self.assertEqual(values, ['first', 'triggered', 'fourth'])
+        self.assertEqual(self.scheduler.stats('job')['skipped'], 2)
+        self.assertEqual(self.scheduler._serial, {})
+
+    def test_task_exception(self):
+        # an exception escaping _task() neither kills the worker nor blocks later runs of the name
+        class Logic():
+            executor = 'process'
+
+        class FailingExecutor():
+            def run(self, *args):
+                raise OSError('no process')
+        self.scheduler._process_executor = FailingExecutor()
+        for i in range(2):
+            self.scheduler.trigger('logic', Logic())
+            self._run_queued()
+        self.assertEqual(self.scheduler._serial, {})
+        stats = self.scheduler.stats('logic')
+        self.assertEqual((stats['runs'], stats['exceptions'], stats['running']), (2, 2, 0))
+        self.scheduler._process_executor = None
+
+    def test_serial_skip(self):
+        self.assertEqual(self._serial_run('skip'), ['first', 'other'])
+        self.assertEqual(self.scheduler.stats('serial')['skipped'], 2)
+
+    def test_serial_latest(self):
+        self.assertEqual(self._serial_run('latest'), ['first', 'other', 'third'])
+        self.assertEqual(self.scheduler.stats('serial')['skipped'], 1)
+
+    def test_serial_parallel(self):
+        self.assertEqual(self._serial_run('parallel'), ['first', 'second', 'third', 'other'])
+
+    def test_shedding(self):
+        self.sh._scheduler_queue_low = '2 drop_oldest'
+        self.sh._scheduler_queue_normal = '2 drop_duplicates'
+        self.sh._scheduler_queue_high = '1'
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+        values = []
+
+        def append(value):
+            values.append(value)
+        for value in range(4):
+            self.scheduler.trigger('low{}'.format(value), append, prio=8, value={'value': 'low{}'.format(value)})
+        self.scheduler.trigger('normal', append, value={'value': 'normal'})
+        self.scheduler.trigger('dup', append, value={'value': 'dup1'})
+        self.scheduler.trigger('dup', append, value={'value': 'dup2'})
+        self.scheduler.trigger('other', append, value={'value': 'other'})
+        self.scheduler.trigger('high', append, prio=1, value={'value': 'high1'})
+        self.scheduler.trigger('high', append, prio=1, value={'value': 'high2'})
+        queue = self.scheduler.queue()
+        self.assertEqual([queue[band]['queued'] for band in ('high', 'normal', 'low')], [1, 3, 2])
+        self.assertEqual([queue[band]['shed'] for band in ('high', 'normal', 'low')], [1, 1, 2])
+        self.assertEqual(queue['low']['policy'], 'drop_oldest')
+        self._run_queued()
+        self.assertEqual(values, ['high1', 'normal', 'dup1', 'other', 'low2', 'low3'])
+        self.assertEqual(sum(band['queued'] for band in self.scheduler.queue().values()), 0)
+
+    def test_shedding_bounded(self):
+        # shed tasks are removed from the run queue, not only skipped when they are dequeued
+        self.sh._scheduler_queue_low = '100 drop_oldest'
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+        for value in range(5000):
+            self.scheduler.trigger('low{}'.format(value), lambda: None, prio=8 - value % 3)
+            self.assertLessEqual(self.scheduler._runq.qsize(), 100)
+        self.assertEqual(self.scheduler._runq.qsize(), 100)
+        queue = self.scheduler.queue()
+        self.assertEqual((queue['low']['queued'], queue['low']['shed']), (100, 4900))
+        names = set()
+        while self.scheduler._runq.qsize():
+            names.add(self.scheduler._runq.get(block=False)['name'])
+        self.assertEqual(names, set('low{}'.format(value) for value in range(4900, 5000)))
+
+    def test_overrun(self):
+        now = self.sh.now()
+        self.scheduler.add('slow', self._dummy, next=now - datetime.timedelta(seconds=1))
+        self.scheduler._running['slow'] = 1
+        self.scheduler._schedule_due(self.scheduler._monotonic(now))
+        self.assertEqual(self.scheduler.stats('slow')['overruns'], 1)
+
+    def test_pool_grows_and_shrinks(self):
+        self.sh._scheduler_workers_min = '1'
+        self.sh._scheduler_workers_idle = '0.2'
+        self.sh._scheduler_workers_grow = '0.05'
+        self.scheduler = lib.scheduler.Scheduler(self.sh)
+        release = threading.Event()
+        self.scheduler.start()
+        try:
+            for i in range(3):
+                self.scheduler.trigger('block{}'.format(i), release.wait, value={'timeout': 5})
+            time.sleep(0.5)
+            self.scheduler._check_pool()
+            self.assertGreater(self.scheduler.workers()['size'], 1)
+            self.assertEqual(self.scheduler.workers()['peak'], self.scheduler.workers()['size'])
+            release.set()
+            time.sleep(2)
+            self.assertEqual(self.scheduler.workers()['size'], 1)
+        finally:
+            release.set()
+            self.scheduler.stop()
+            self.scheduler.join(2)
+
+    def _dummy(self):
+        pass
+
+    def _fail(self):
+        raise ValueError('test')
+
+
+class TestProcessExecutor(unittest.TestCase):
+
+    def test_run_logic(self):
+        sh = MockSmartHome()
+        sh.items = {'source': MockItem(21), 'result': MockItem(None)}
+        with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+            f.write("logger.info('running')\nsh.result(sh.source() * 2 + trigger['value'])\nsh.trigger('other', value=os.getpid())\n")
+        try:
+            logic = lib.logic.Logic(sh, 'heavy', {'filename': f.name, 'executor': 'process'})
+            executor = lib.executor.ProcessExecutor(sh, 1)
+            try:
+                self.assertTrue(executor.run(logic, 'Test', None, None, 1))
+                self.assertEqual(sh.items['result'].values, [43])
+                self.assertEqual(sh.triggered[0]['name'], 'other')
+                self.assertNotEqual(sh.triggered[0]['value'], os.getpid())
+                self.assertEqual(executor._prefetch['heavy'], ['source'])
+                self.assertTrue(executor.run(logic, 'Test', None, None, 2))
+                self.assertEqual(sh.items['result'].values, [43, 44])
+            finally:
+                executor.stop()
+        finally:
+            os.remove(f.name)
+
+    def test_start_failure(self):
+        # the logic fails, the worker thread calling run() does not
+        class Context():
+            Pipe = staticmethod(multiprocessing.Pipe)
+
+            class Process():
+                def __init__(self, **kwargs):
+                    pass
+
+                def start(self):
+                    raise OSError('no more processes')
+        logic = lib.logic.Logic(MockSmartHome(), 'heavy', {'filename': 'heavy.py', 'executor': 'process'})
+        executor = lib.executor.ProcessExecutor(MockSmartHome(), 1)
+        executor._context = Context()
+        self.assertFalse(executor.run(logic, 'Test', None, None, 1))
+        self.assertEqual(executor._processes, [])
+
+
+class MockItem():
+
+    def __init__(self, value):
+        self.values = [] if value is None else [value]
+
+    def __call__(self, value=None, caller='Logic', source=None, dest=None):
+        if value is None:
+            return self.values[-1]
+        self.values.append(value)
+
+
+class CountingLock():
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.count = 0
+
+    def __enter__(self):
+        self.count += 1
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
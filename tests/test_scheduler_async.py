@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG
+#  https://github.com/smarthomeNG/smarthome
+#  http://knx-user-forum.de/
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+import common
+import asyncio
+import datetime
+import threading
+import time
+import unittest
+
+import lib.scheduler_async
+from common import MockSmartHome
+
+# async def needs Python 3.5 or newer, older versions skip this file (see conftest.py)
+
+
+class TestAsyncScheduler(unittest.TestCase):
+
+    def test_run(self):
+        sh = MockSmartHome()
+        scheduler = lib.scheduler_async.AsyncScheduler(sh)
+        threads = {}
+        done = threading.Event()
+
+        def blocking(name='cycle'):
+            threads[name] = threading.current_thread()
+
+        async def native(name):
+            await asyncio.sleep(0.01)
+            threads[name] = threading.current_thread()
+            done.set()
+        scheduler.add('cycle', blocking, cycle=0.1, offset=0.1)
+        scheduler.start()
+        try:
+            time.sleep(0.1)
+            start = time.time()
+            scheduler.trigger('native', native, value={'name': 'native'}, dt=sh.now() + datetime.timedelta(seconds=0.2))
+            self.assertTrue(done.wait(2))
+            self.assertLess(time.time() - start, 0.5)
+            self.assertIs(threads['native'], scheduler)  # the thread of the event loop
+            self.assertIsNot(threads['cycle'], scheduler)
+            time.sleep(0.3)
+            self.assertGreater(scheduler.stats('cycle')['runs'], 3)
+            self.assertEqual(scheduler.stats('native')['exceptions'], 0)
+        finally:
+            scheduler.stop()
+            scheduler.join(2)
+        self.assertFalse(scheduler.is_alive())